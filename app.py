@@ -1,28 +1,176 @@
 import streamlit as st
+from warmup import mark_first, start_warmup # First, so cold-start times count from here
 from utils import (
     generate_initial_plot_blocking, # For initial plot
     generate_continuation_stream,   # For continuations
-    generate_comic_image,
-    format_story_history
+    submit_comic_image              # Panels render in the background
 )
+from cancellation import CancelScope, Cancelled
+from metrics import metrics, start_exporters
+from comic_pages import PANELS_PER_PAGE, panel_captions, render_page, story_pages
+from panel_store import panel_store
+from scheduler import PRIORITY_TEXT, admission
+from session_store import session_store
+from pdf_export import export_story_pdf
+from prompts import THEME_DESCRIPTIONS
+from story_context import StoryContext
+from streaming import StreamRenderer
+from warm_pool import WarmPool
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+import html
 import os
+import secrets
 import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Define theme descriptions
-THEME_DESCRIPTIONS = {
-    "Final Destination": "Death has a plan — and your character is in its path. Each move by the user brings danger, but the AI must twist fate and keep them alive. Expect close calls, clever saves, and suspense at every step.",
-    "Survival": "Nature shows no mercy. Your character is being hunted — not by a person, but by the world itself. From collapsing caves to monster ambushes, the AI launches life-threatening events. The user must fight to keep the story (and character) alive.",
-    "Superhero Tale": "Behind every mask is a secret. Dive into the double life of a hero blessed (or cursed) with powers, fighting not just crime but personal battles. Supervillains rise. Cities fall. And one hero stands in the middle.",
-    "Fantasy Adventure": "Step into a world where dragons fly, spells crackle in the air, and ancient maps lead to hidden realms. Magic pulses through every tree and stone — and your character is about to set foot on a quest that will test their courage, wits, and heart.",
-    "Mystery": "Whispers in the dark. Clues in plain sight. Someone is hiding the truth — and your character is on the trail. In a world filled with riddles and red herrings, only sharp minds and sharper instincts will survive.",
-    "Slice of Life": "Sometimes, the quietest moments say the most. Follow your character through life’s small joys, awkward stumbles, and deep connections. From classrooms to coffee shops, this is a story about being human — honest, funny, and real.",
-    "Sci-Fi Journey": "Rocket through galaxies, hack into alien tech, and face decisions that shape the fate of civilizations. From abandoned space stations to worlds ruled by AIs, your character must navigate the future — one jump at a time."
-}
+# Number of player rounds in a story. Prompt size no longer grows with the
+# story (see story_context), so this can be raised freely.
+MAX_ROUNDS = int(os.getenv("MAX_ROUNDS", "10"))
+
+def render_entry_html(entry):
+    """HTML block for one story entry."""
+    content = html.escape(entry['content']).replace("\n", "<br>")
+    if entry['type'] == 'plot':
+        heading = "✨ Story Introduction ✨"
+    elif entry['type'] == 'user':
+        heading = f"👤 {html.escape(entry['character_name'])} Says:"
+    else:
+        heading = "🤖 AI Continues:"
+    return f"<div class='story-entry {entry['type']}-entry'><h4>{heading}</h4><p>{content}</p></div><hr>"
+
+def story_html():
+    """HTML for the whole story so far.
+
+    Entries never change once added, so each one is rendered only once and the
+    cache in session state just grows with the story.
+    """
+    rendered = st.session_state.story_html
+    history = st.session_state.story_history
+    if len(rendered) > len(history): # History was reset underneath the cache
+        rendered.clear()
+    for entry in history[len(rendered):]:
+        rendered.append(render_entry_html(entry))
+    return "".join(rendered)
+
+def panel_status(idx, future, elapsed=None):
+    """Progress text for a panel that is still queued or rendering."""
+    position = future.ticket.position
+    if position:
+        return f"⏳ Panel {idx + 1} is #{position} in line for the image generator..."
+    return f"🎨 Drawing panel {idx + 1}..." + (f" ({elapsed}s)" if elapsed is not None else "")
+
+def show_page(page, image_slot, status_slot, captions, elapsed=None):
+    """Draws comic page `page` (up to 4 panels) and the progress of its unfinished panels."""
+    first = page * PANELS_PER_PAGE
+    panels = st.session_state.image_urls[first:first + PANELS_PER_PAGE]
+    page_image = render_page(panels, captions[first:first + PANELS_PER_PAGE], page) # path, or bytes while drawing
+    image_slot.image(page_image, caption=f"Page {page + 1}", use_column_width=True)
+    update_page_status(page, status_slot, elapsed)
+
+def update_page_status(page, status_slot, elapsed=None):
+    """Progress text for the panels of a page that are still queued or rendering."""
+    first = page * PANELS_PER_PAGE
+    pending = [
+        panel_status(idx, panel, elapsed)
+        for idx, panel in enumerate(st.session_state.image_urls[first:first + PANELS_PER_PAGE], first)
+        if isinstance(panel, Future) and not panel.done()
+    ]
+    if pending:
+        status_slot.info("\n\n".join(pending))
+    else:
+        status_slot.empty()
+
+def show_full_size(page):
+    """Shows the finished panels of a page one by one at full resolution."""
+    first = page * PANELS_PER_PAGE
+    for idx, img_url in enumerate(st.session_state.image_urls[first:first + PANELS_PER_PAGE], first):
+        if panel_store.has(img_url):
+            st.image(panel_store.full(img_url), caption=f"Panel {idx + 1}", use_column_width=True)
+        elif isinstance(img_url, str) and img_url.startswith(("http://", "https://")):
+            st.image(img_url, caption=f"Panel {idx + 1}", use_column_width=True) # Remote URL the store could not keep
+        elif isinstance(img_url, str) and img_url and not img_url.startswith("error_"):
+            # A panel key saved by another server whose store this one can't read
+            st.caption(f"Panel {idx + 1} isn't available on this server.")
+
+def round_labels():
+    """Metric tags for work done on behalf of the current round."""
+    return {"theme": st.session_state.theme, "round": st.session_state.current_round}
+
+def wait_for_turn(ticket, slot):
+    """Shows the player's place in line until their admission ticket is granted."""
+    try:
+        while not ticket.wait(timeout=0.5):
+            slot.info(f"⏳ Lots of stories are being written right now. You're #{ticket.position} in line...")
+    except BaseException:
+        ticket.release() # Leave the line if this script run is interrupted
+        raise
+    slot.empty()
+    return ticket
+
+def new_cancel_scope():
+    """Cancels whatever the previous story still had running and starts a fresh scope."""
+    if 'cancel_scope' in st.session_state:
+        st.session_state.cancel_scope.cancel("reset")
+    st.session_state.cancel_scope = CancelScope()
+    return st.session_state.cancel_scope
+
+def add_entry(entry):
+    """Appends an entry to the story history and saves it."""
+    try:
+        session_store.append_entry(st.session_state.story_id, len(st.session_state.story_history), entry)
+    except Exception as e:
+        print(f"Could not save story entry: {e}")
+    st.session_state.story_history.append(entry)
+
+def finish_panel(idx, value):
+    """Records the final value of panel `idx` and saves it."""
+    st.session_state.image_urls[idx] = value
+    try:
+        session_store.set_panel(st.session_state.story_id, idx, value)
+    except Exception as e:
+        print(f"Could not save panel {idx + 1}: {e}")
+    return value
+
+def resume_story(story_id):
+    """Loads a saved story into this session; returns False if there is nothing to resume."""
+    story = session_store.load(story_id)
+    if not story or not story["entries"]:
+        return False
+    cancel_scope = new_cancel_scope()
+    st.session_state.story_id = story_id
+    st.session_state.email = story["email"]
+    st.session_state.character = story["character"]
+    st.session_state.theme = story["theme"]
+    st.session_state.description = story["description"]
+    st.session_state.story_history = story["entries"]
+    st.session_state.story_html = []
+    st.session_state.story_context = StoryContext(cancel_token=cancel_scope.root)
+    st.session_state.story_context.schedule_summary([item['content'] for item in story["entries"]])
+    # Panels are drawn from the plot and each AI reply; redraw any that never finished
+    panel_sources = [item['content'] for item in story["entries"] if item['type'] in ('plot', 'ai')]
+    st.session_state.image_urls = [
+        story["panels"][idx] if idx in story["panels"] else submit_comic_image(
+            content, labels={"theme": story["theme"], "round": idx}, cancel_token=cancel_scope.root,
+            character=story["character"], theme=story["theme"]
+        )
+        for idx, content in enumerate(panel_sources)
+    ]
+    st.session_state.current_round = len(panel_sources)
+    # Picks the reply generation back up if the story stopped right after an action
+    st.session_state.generating_ai_response = story["entries"][-1]['type'] == 'user'
+    st.experimental_set_query_params(story=story_id)
+    return True
+
+@st.cache_resource
+def get_warm_pool():
+    """Process-wide pool of pre-generated openings, filled once per server."""
+    return WarmPool(THEME_DESCRIPTIONS).start()
 
 # Initialize session state variables
+if 'cancel_scope' not in st.session_state: # Cancels this session's model calls on reset or when abandoned
+    st.session_state.cancel_scope = CancelScope()
 if 'current_round' not in st.session_state:
     st.session_state.current_round = 0
 if 'story_history' not in st.session_state:
@@ -32,19 +180,39 @@ if 'story_history' not in st.session_state:
     #       {'type': 'ai', 'content': '...'}
     st.session_state.story_history = []
 if 'image_urls' not in st.session_state:
+    # One slot per panel: a Future while the panel is still rendering, then its
+    # panel_store key, an "error_*" marker or None once the job has finished.
     st.session_state.image_urls = []
 if 'character' not in st.session_state:
     st.session_state.character = ""
 if 'theme' not in st.session_state:
     st.session_state.theme = ""
+if 'story_id' not in st.session_state: # Key of the story in session_store, also in the URL
+    st.session_state.story_id = ""
 if 'email' not in st.session_state:
     st.session_state.email = ""
+if 'story_html' not in st.session_state: # Rendered HTML of each finished story entry
+    st.session_state.story_html = []
+if 'story_context' not in st.session_state: # Rolling summary + recent turns for prompts
+    st.session_state.story_context = StoryContext(cancel_token=st.session_state.cancel_scope.root)
 if 'generating_ai_response' not in st.session_state: # Flag to manage AI response generation
     st.session_state.generating_ai_response = False
 
+start_exporters() # Metrics endpoint / file, if configured; no-op after the first run
+start_warmup() # Loads the model SDKs in the background while the first page renders
+if st.session_state.theme:
+    metrics.inc("script_runs_total", **round_labels())
+
 # Page config
 st.set_page_config(page_title="AI Comic Story Creator", layout="wide")
 
+# A fresh session (page reload, server restart, another worker) picks its story
+# back up from the store, the first time it runs without one in memory
+if not st.session_state.story_history:
+    saved_story_id = st.experimental_get_query_params().get("story", [""])[0]
+    if saved_story_id and not resume_story(saved_story_id):
+        st.experimental_set_query_params() # Unknown or empty story; start fresh
+
 # Custom CSS (remains the same as your current version)
 st.markdown("""
 <style>
@@ -144,10 +312,10 @@ with st.sidebar:
         st.markdown("---")
     
     st.subheader("Progress")
-    progress_value = st.session_state.current_round / 10
+    progress_value = min(st.session_state.current_round / MAX_ROUNDS, 1.0)
     st.progress(progress_value)
-    st.write(f"Round {st.session_state.current_round}/10")
-    if st.session_state.current_round >= 10:
+    st.write(f"Round {st.session_state.current_round}/{MAX_ROUNDS}")
+    if st.session_state.current_round >= MAX_ROUNDS:
         st.balloons()
 
 
@@ -155,6 +323,7 @@ with st.sidebar:
 
 # --- Initial Story Setup (Round 0) ---
 if st.session_state.current_round == 0:
+    get_warm_pool() # Starts filling the pool on the server's first visitor
     st.subheader("Start Your Story")
     col1_form, col2_form = st.columns(2)
     with col1_form:
@@ -180,86 +349,110 @@ if st.session_state.current_round == 0:
             
             st.session_state.story_history = [] # Clear any previous history
             st.session_state.image_urls = []
+            st.session_state.story_html = []
+            cancel_scope = new_cancel_scope()
+            st.session_state.story_context = StoryContext(cancel_token=cancel_scope.root)
+            st.session_state.story_id = secrets.token_urlsafe(12)
+            try:
+                session_store.create(st.session_state.story_id, email, character, theme, st.session_state.description)
+            except Exception as e:
+                print(f"Could not save new story: {e}")
+            st.experimental_set_query_params(story=st.session_state.story_id)
 
-            with st.spinner("⏳ Creating the story plot for you..."):
-                initial_plot_content = generate_initial_plot_blocking(
-                    st.session_state.character, 
-                    st.session_state.theme,
-                    st.session_state.description
-                )
+            # Serve a pre-generated opening when one is ready, else generate it live
+            initial_plot_content = get_warm_pool().take(st.session_state.theme, st.session_state.character)
+            if initial_plot_content is None:
+                ticket = wait_for_turn(admission.request("openai", PRIORITY_TEXT), st.empty())
+                with st.spinner("⏳ Creating the story plot for you..."):
+                    try:
+                        initial_plot_content = generate_initial_plot_blocking(
+                            st.session_state.character, 
+                            st.session_state.theme,
+                            st.session_state.description,
+                            labels=round_labels(),
+                            ticket=ticket,
+                            cancel_token=cancel_scope.token("story_text")
+                        )
+                    except Cancelled:
+                        st.stop() # A newer run took over this story
             
             if initial_plot_content:
-                st.session_state.story_history.append({'type': 'plot', 'content': initial_plot_content})
+                add_entry({'type': 'plot', 'content': initial_plot_content})
             else:
                 st.error("💥 Apologies! The AI couldn't generate the initial plot. Please try again.")
                 # Optionally, prevent moving to next round if plot fails
                 st.stop() # Stop further execution in this script run
 
 
-            with st.spinner("🎨 Generating first comic panel..."):
-                image_url = generate_comic_image(initial_plot_content)
-                if image_url == "error_nsfw":
-                    st.warning("🎨 The story opening was a bit too graphic for the image generator. No comic panel this time, but the story continues!")
-                elif isinstance(image_url, str) and image_url.startswith("error_"):
-                    st.error("😢 Oops! Couldn't generate the first comic panel due to a model error.")
-                elif image_url: # Check if it's a valid URL (truthy string)
-                    st.session_state.image_urls.append(image_url)
-                else: # None or empty output from model
-                    st.error("😢 Oops! Couldn't generate the first comic panel. The model returned no image.")
+            # The first panel renders in the background while round 1 is shown
+            st.session_state.image_urls.append(submit_comic_image(
+                initial_plot_content, labels=round_labels(), cancel_token=cancel_scope.root,
+                character=st.session_state.character, theme=st.session_state.theme
+            ))
             
             st.session_state.current_round = 1
             st.experimental_rerun()
         else:
             st.error("❗ Please fill in all fields: Email, Character Name, and Theme.")
 
-# --- Story Continuation (Rounds 1-10) ---
+# --- Story Continuation (Rounds 1-MAX_ROUNDS) ---
 else:
     col1_story, col2_panels = st.columns([4,3]) # Adjusted column ratio
 
     with col1_story:
         st.subheader("📜 Story Progress")
         
-        # Display story history from the structured list
-        for i, entry in enumerate(st.session_state.story_history):
-            if entry['type'] == 'plot':
-                st.markdown(f"<div class='story-entry plot-entry'><h4>✨ Story Introduction ✨</h4><p>{entry['content']}</p></div>", unsafe_allow_html=True)
-            elif entry['type'] == 'user':
-                st.markdown(f"<div class='story-entry user-entry'><h4>👤 {entry['character_name']} Says:</h4><p>{entry['content']}</p></div>", unsafe_allow_html=True)
-            elif entry['type'] == 'ai':
-                st.markdown(f"<div class='story-entry ai-entry'><h4>🤖 AI Continues:</h4><p>{entry['content']}</p></div>", unsafe_allow_html=True)
-            st.markdown("---") # Separator
+        # Display story history as a single block; finished entries are cached as HTML
+        story_view = st.empty()
+        story_view.markdown(story_html(), unsafe_allow_html=True)
 
         # User input area for next part of the story
-        if st.session_state.current_round <= 10:
+        if st.session_state.current_round <= MAX_ROUNDS:
             if not st.session_state.generating_ai_response: # Only show input if not waiting for AI
-                user_input = st.text_area(f"Round {st.session_state.current_round}/10: What does {st.session_state.character} do next?", key=f"user_input_round_{st.session_state.current_round}")
+                input_slot = st.empty()
+                with input_slot.container():
+                    user_input = st.text_area(f"Round {st.session_state.current_round}/{MAX_ROUNDS}: What does {st.session_state.character} do next?", key=f"user_input_round_{st.session_state.current_round}")
+                    continue_clicked = st.button("➡️ Continue Story", key=f"continue_btn_{st.session_state.current_round}")
                 
-                if st.button("➡️ Continue Story", key=f"continue_btn_{st.session_state.current_round}"):
+                if continue_clicked:
                     if user_input:
                         # Add user input to history
-                        st.session_state.story_history.append({
+                        add_entry({
                             'type': 'user',
                             'character_name': st.session_state.character,
                             'content': user_input
                         })
                         st.session_state.generating_ai_response = True # Set flag
-                        st.experimental_rerun() # Rerun to show user input, then generate AI response
+                        # Show the action and generate the reply in this same run
+                        input_slot.empty()
+                        story_view.markdown(story_html(), unsafe_allow_html=True)
                     else:
                         st.warning("❗ Please tell us what happens next!")
             
-            # AI Response Generation (triggered after user input is added and rerun)
+            # AI Response Generation (right after the user input is added, or
+            # resumed if a previous run was interrupted mid-generation)
             if st.session_state.generating_ai_response and st.session_state.story_history[-1]['type'] == 'user':
+                # Prepare history string for the AI prompt: a summary of older
+                # turns plus recent ones verbatim. The latest action is passed separately.
+                # Built before taking an OpenAI slot: the summary it may wait on
+                # needs a slot of its own, at lower priority than this request.
+                history_for_prompt = st.session_state.story_context.build(
+                    [item['content'] for item in st.session_state.story_history[:-1]]
+                )
+                latest_user_input = st.session_state.story_history[-1]['content']
+                # Under load, show the player's place in line instead of failing
+                ticket = wait_for_turn(admission.request("openai", PRIORITY_TEXT), st.empty())
                 with st.spinner(f"🤖 AI is crafting the next part of {st.session_state.character}'s story..."):
-                    # Prepare history string for the AI prompt
-                    history_for_prompt = format_story_history([item['content'] for item in st.session_state.story_history])
-                    latest_user_input = st.session_state.story_history[-1]['content']
-
                     ai_stream_gen = generate_continuation_stream(
                         history_for_prompt,
                         latest_user_input,
                         st.session_state.character,
                         st.session_state.theme,
-                        st.session_state.description
+                        st.session_state.description,
+                        labels=round_labels(),
+                        ticket=ticket,
+                        # Supersedes a generation an interrupted run left behind
+                        cancel_token=st.session_state.cancel_scope.token("story_text")
                     )
                     
                     # Stream and capture AI response
@@ -267,41 +460,44 @@ else:
                     ai_response_placeholder = st.empty() # Create a placeholder for the streaming output
                     
                     # This is where the AI response will be streamed directly to the UI
-                    # And also captured for history and image generation
-                    streamed_content_list = []
-                    for chunk in ai_stream_gen: # ai_stream_gen is the raw generator
-                        streamed_content_list.append(chunk)
-                        ai_response_placeholder.markdown("".join(streamed_content_list))
-                    ai_response_content = "".join(streamed_content_list)
+                    # And also captured for history and image generation.
+                    # Tokens are batched into frames so the page isn't repainted per token.
+                    renderer = StreamRenderer(ai_response_placeholder)
+                    try:
+                        for chunk in ai_stream_gen: # ai_stream_gen is the raw generator
+                            renderer.feed(chunk)
+                    except Cancelled:
+                        st.stop() # A newer run took over this round
+                    ai_response_content = renderer.finish()
+                    metrics.observe("stream_frames", renderer.frames, **round_labels())
 
                 # Add full AI response to history
-                st.session_state.story_history.append({'type': 'ai', 'content': ai_response_content})
+                add_entry({'type': 'ai', 'content': ai_response_content})
+                # Summarize turns leaving the verbatim window while the player reads
+                st.session_state.story_context.schedule_summary([item['content'] for item in st.session_state.story_history])
                 
-                with st.spinner(f"🎨 Generating comic panel for Round {st.session_state.current_round}..."):
-                    image_url = generate_comic_image(ai_response_content) # Use AI response for image
-                    if image_url == "error_nsfw":
-                        st.warning(f"🎨 The AI's response for Round {st.session_state.current_round} was a bit too graphic for the image generator. No panel, but the story goes on!")
-                    elif isinstance(image_url, str) and image_url.startswith("error_"):
-                        st.error(f"😢 Oops! Couldn't generate the comic panel for Round {st.session_state.current_round} due to a model error.")
-                    elif image_url: # Check if it's a valid URL (truthy string)
-                        st.session_state.image_urls.append(image_url)
-                    else: # None or empty output from model
-                        st.error(f"😢 Oops! Couldn't generate the comic panel for Round {st.session_state.current_round}. The model returned no image.")
+                # Use AI response for image; the user can type the next action while it renders
+                st.session_state.image_urls.append(submit_comic_image(
+                    ai_response_content, labels=round_labels(), cancel_token=st.session_state.cancel_scope.root,
+                    character=st.session_state.character, theme=st.session_state.theme
+                ))
                 
                 st.session_state.current_round += 1
                 st.session_state.generating_ai_response = False # Reset flag
                 st.experimental_rerun()
 
-        elif st.session_state.current_round > 10:
-            st.success("🎉 Congratulations! Your 10-round comic story is complete!")
+        elif st.session_state.current_round > MAX_ROUNDS:
+            st.success(f"🎉 Congratulations! Your {MAX_ROUNDS}-round comic story is complete!")
             st.markdown("You can review your story and comic panels.")
-            # Placeholder for PDF generation and email
-            if st.button("📜 Download Story as PDF (Coming Soon!)"):
-                st.info("PDF generation feature is under development.")
+            # Filled in at the end of the script, once every panel has finished
+            pdf_slot = st.empty()
             if st.button("🔄 Start a New Story"):
-                # Clear all session state to reset the app
+                # Stop any model calls still running for this story, then
+                # clear all session state to reset the app
+                st.session_state.cancel_scope.cancel("reset")
                 for key in list(st.session_state.keys()):
                     del st.session_state[key]
+                st.experimental_set_query_params() # The old story stays saved under its id
                 st.experimental_rerun()
 
     with col2_panels:
@@ -309,9 +505,64 @@ else:
         if not st.session_state.image_urls:
             st.info("Your comic panels will appear here as the story unfolds!")
         
+        # Panels are shown composited into pages of four with captions, so a
+        # rerun sends one image per page, and a finished panel redraws only its page
         for idx, img_url in enumerate(st.session_state.image_urls):
-            if img_url:
-                st.image(img_url, caption=f"Panel {idx + 1}", use_column_width=True)
-            else:
-                st.warning(f"😢 Panel {idx + 1} could not be generated.")
+            if isinstance(img_url, Future) and img_url.done():
+                finish_panel(idx, img_url.result())
+        captions = panel_captions(st.session_state.story_history)
+        page_slots = [] # page -> (image placeholder, status placeholder)
+        for page in range((len(st.session_state.image_urls) + PANELS_PER_PAGE - 1) // PANELS_PER_PAGE):
+            page_slots.append((st.empty(), st.empty()))
+            show_page(page, *page_slots[page], captions)
+            # Full resolution is only read and sent on request
+            if st.checkbox("🔍 Full size", key=f"page_full_{page}"):
+                show_full_size(page)
             st.markdown("---")
+        pending_panels = {
+            img_url: idx for idx, img_url in enumerate(st.session_state.image_urls) if isinstance(img_url, Future)
+        }
+
+        # Fill in panels as their jobs finish. Everything above, including the
+        # input box for the next round, is already on the page and usable; the
+        # periodic placeholder update lets Streamlit interrupt this loop as soon
+        # as the user submits their next action.
+        wait_started = time.time()
+        while pending_panels:
+            done, _ = wait(list(pending_panels), timeout=0.5, return_when=FIRST_COMPLETED)
+            changed_pages = set()
+            for future in done:
+                idx = pending_panels.pop(future)
+                finish_panel(idx, future.result())
+                changed_pages.add(idx // PANELS_PER_PAGE)
+            elapsed = int(time.time() - wait_started)
+            # Redraw pages that got a panel; elsewhere only the progress text changes
+            for page in changed_pages | {idx // PANELS_PER_PAGE for idx in pending_panels.values()}:
+                if page in changed_pages:
+                    show_page(page, *page_slots[page], captions, elapsed)
+                else:
+                    update_page_status(page, page_slots[page][1], elapsed)
+
+    if st.session_state.current_round > MAX_ROUNDS:
+        # Every panel is final now. The export runs in a worker process and is
+        # cached by story, so reruns and repeat downloads reuse the same file.
+        story_title = f"{st.session_state.character}'s {st.session_state.theme} Story"
+        # The PDF embeds the same composited pages the panel column shows
+        page_paths = story_pages(st.session_state.story_history, st.session_state.image_urls)
+        pdf_future = export_story_pdf(story_title, st.session_state.story_history, page_paths)
+        with pdf_slot.container():
+            try:
+                with st.spinner("📜 Preparing your PDF..."):
+                    pdf_path = pdf_future.result()
+                with open(pdf_path, "rb") as pdf_file:
+                    st.download_button(
+                        "📜 Download Story as PDF",
+                        data=pdf_file.read(),
+                        file_name=f"{story_title}.pdf",
+                        mime="application/pdf",
+                    )
+            except Exception as e:
+                print(f"PDF export failed: {e}")
+                st.error("😢 Oops! Couldn't create the PDF for your story.")
+
+mark_first("page") # End of the first script run this process served
@@ -0,0 +1,202 @@
+"""Headless batch story generation.
+
+Reads a JSONL file of story jobs and plays each one through the same round
+flow as app.py, with the scripted actions standing in for the player:
+    {"id": "rex-1", "character": "Detective Rex", "theme": "Mystery",
+     "actions": ["Rex checks the window.", "Rex follows the footprints.", ...]}
+`id` defaults to the job's line number, and `description` to the theme's.
+
+Stories run in parallel on --workers threads, with at most --concurrency LLM
+calls in flight across them; panels render in the background and land in the
+panel store, and are composited into comic pages once the story is done.
+Progress is checkpointed entry by entry, and panel by panel as each one is
+drawn, in a session store database, so an interrupted run picks every story
+up where it stopped. Each finished story is appended to the output as one
+JSON line, and jobs already in the output are skipped.
+
+    python batch.py jobs.jsonl --output stories.jsonl --workers 8 --concurrency 16
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from comic_pages import story_pages
+from panel_store import panel_store
+from prompts import THEME_DESCRIPTIONS
+from session_store import SQLiteSessionStore
+from story_context import StoryContext
+from utils import generate_continuation_stream, generate_initial_plot_blocking, submit_comic_image
+
+MAX_ROUNDS = int(os.getenv("MAX_ROUNDS", "10"))
+# Kept apart from the app's session store: batch story ids are guessable, and
+# the app opens any story in its store by id
+BATCH_DB_PATH = os.getenv("BATCH_DB_PATH", ".batch_sessions.db")
+
+
+def read_jobs(path):
+    """Jobs from a JSONL file, each with an `id`."""
+    jobs = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            job["id"] = str(job.get("id", line_number))
+            if not job.get("description") and job.get("theme") not in THEME_DESCRIPTIONS:
+                raise ValueError(f"line {line_number}: unknown theme {job.get('theme')!r} and no description")
+            jobs.append(job)
+    return jobs
+
+
+def finished_ids(path):
+    """Ids of the jobs already written to the output file.
+
+    Lines that don't parse, such as one cut off when an earlier run was
+    killed, are skipped, so those jobs run again.
+    """
+    ids = set()
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    ids.add(json.loads(line)["id"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return ids
+
+
+def _panel_sources(history):
+    # Panels are drawn from the plot and each AI reply, in order
+    return [entry["content"] for entry in history if entry["type"] in ("plot", "ai")]
+
+
+def run_job(job, store, rounds, llm_slots):
+    """Plays one job's story to the end and returns its output record.
+
+    Resumes from the job's checkpoint in `store`, if there is one.
+    """
+    story_id = f"batch-{job['id']}"
+    character, theme = job["character"], job["theme"]
+    description = job.get("description") or THEME_DESCRIPTIONS[theme]
+    actions = job["actions"][:rounds]
+    labels = {"theme": theme, "source": "batch"}
+
+    saved = store.load(story_id)
+    if saved is None:
+        store.create(story_id, job.get("email"), character, theme, description)
+        history, panels = [], {}
+    else:
+        history, panels = saved["entries"], saved["panels"]
+    panel_jobs = {} # panel index -> Future
+
+    def save_panel(idx, future):
+        # Checkpointed as soon as it is drawn, so an interrupted run never pays for it twice
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            store.set_panel(story_id, idx, future.result())
+        except Exception as e:
+            print(f"Story {job['id']}: could not save panel {idx + 1}: {e}", file=sys.stderr)
+
+    def draw_panel(idx, content):
+        panel_jobs[idx] = submit_comic_image(content, {**labels, "round": idx}, character=character, theme=theme)
+        panel_jobs[idx].add_done_callback(lambda future, idx=idx: save_panel(idx, future))
+
+    def add_entry(entry):
+        store.append_entry(story_id, len(history), entry)
+        history.append(entry)
+        if entry["type"] != "user":
+            draw_panel(len(_panel_sources(history)) - 1, entry["content"])
+
+    # Panels that never finished before an interruption are drawn again
+    for idx, content in enumerate(_panel_sources(history)):
+        if idx not in panels:
+            draw_panel(idx, content)
+
+    if not history:
+        with llm_slots:
+            plot = generate_initial_plot_blocking(character, theme, description, labels={**labels, "round": 0})
+        if not plot:
+            raise RuntimeError("the opening came back empty")
+        add_entry({"type": "plot", "content": plot})
+
+    context = StoryContext()
+    context.schedule_summary([entry["content"] for entry in history])
+    replies = sum(entry["type"] == "ai" for entry in history)
+    for round_number, action in enumerate(actions[replies:], replies + 1):
+        if history[-1]["type"] != "user": # else the action was saved before an interruption
+            add_entry({"type": "user", "character_name": character, "content": action})
+        history_for_prompt = context.build([entry["content"] for entry in history[:-1]])
+        with llm_slots:
+            stream = generate_continuation_stream(
+                history_for_prompt, history[-1]["content"], character, theme, description,
+                labels={**labels, "round": round_number},
+            )
+            reply = "".join(stream)
+        if not reply:
+            raise RuntimeError(f"round {round_number} came back empty")
+        add_entry({"type": "ai", "content": reply})
+        context.schedule_summary([entry["content"] for entry in history])
+
+    for idx, future in sorted(panel_jobs.items()):
+        panels[idx] = future.result()
+
+    panel_list = [panels.get(idx) for idx in range(len(_panel_sources(history)))]
+    return {
+        "id": job["id"],
+        "story_id": story_id,
+        "character": character,
+        "theme": theme,
+        "story_history": history,
+        "panels": panel_list,
+        "panel_paths": [panel_store.path(key) if panel_store.has(key) else None for key in panel_list],
+        "page_paths": story_pages(history, panel_list),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobs", help="JSONL file of story jobs")
+    parser.add_argument("--output", required=True, help="JSONL file finished stories are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="stories played at once")
+    parser.add_argument("--concurrency", type=int, default=8, help="LLM calls in flight at once, across stories")
+    parser.add_argument("--rounds", type=int, default=MAX_ROUNDS, help="player rounds per story")
+    parser.add_argument("--checkpoint", default=BATCH_DB_PATH, help="session store database for progress (not the app's)")
+    args = parser.parse_args(argv)
+
+    done = finished_ids(args.output)
+    jobs = [job for job in read_jobs(args.jobs) if job["id"] not in done]
+    print(f"{len(jobs)} stories to write ({len(done)} already done)", file=sys.stderr)
+    store = SQLiteSessionStore(args.checkpoint)
+    llm_slots = threading.BoundedSemaphore(args.concurrency)
+    failures = 0
+    started = time.perf_counter()
+    with open(args.output, "a+") as output, ThreadPoolExecutor(max_workers=args.workers) as workers:
+        # Don't append onto a line an interrupted run left half-written
+        if output.tell() and (output.seek(output.tell() - 1), output.read(1))[1] != "\n":
+            output.write("\n")
+        running = {workers.submit(run_job, job, store, args.rounds, llm_slots): job for job in jobs}
+        for future in as_completed(running):
+            job = running[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # Left out of the output, so the next run retries it from its checkpoint
+                failures += 1
+                print(f"Story {job['id']} failed: {e}", file=sys.stderr)
+                continue
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            print(f"Story {job['id']} done", file=sys.stderr)
+    print(f"Finished in {time.perf_counter() - started:.1f}s, {failures} failed", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
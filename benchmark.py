@@ -0,0 +1,283 @@
+"""Offline load test for the story pipeline.
+
+Swaps the OpenAI chat model and Replicate predictions for local stand-ins with
+configurable latency and failure rates, then plays N concurrent sessions
+through the same round flow as app.py:
+    opening -> first panel -> (prompt build, streamed reply, panel) x rounds
+and reports latency percentiles, thread usage and memory as JSON, so runs can
+be compared between versions.
+
+    python benchmark.py --sessions 50 --rounds 10 --output bench.json
+"""
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from PIL import Image
+
+_WORDS = "the hero runs toward a glowing door while thunder rolls across the broken city sky".split()
+
+
+class FakeChatModel(BaseChatModel):
+    """Streams filler text with a set time-to-first-token and token rate."""
+
+    ttft: float = 0.5
+    token_rate: float = 40.0 # tokens per second
+    tokens: int = 90
+    error_rate: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _text_tokens(self):
+        return [random.choice(_WORDS) + ("." if i % 12 == 11 else "") + " " for i in range(self.tokens)]
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.ttft)
+        if random.random() < self.error_rate:
+            raise RuntimeError("fake LLM error")
+        text = []
+        for token in self._text_tokens():
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            text.append(token)
+            time.sleep(1 / self.token_rate)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(text)))])
+
+    async def _agenerate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.ttft)
+        if random.random() < self.error_rate:
+            raise RuntimeError("fake LLM error")
+        text = []
+        for token in self._text_tokens():
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+            text.append(token)
+            await asyncio.sleep(1 / self.token_rate)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(text)))])
+
+
+class FakePrediction:
+    """A prediction that finishes after a random latency, like Replicate's."""
+
+    def __init__(self, backend, input_params):
+        self.id = f"fake-{next(backend.ids)}"
+        self.backend = backend
+        self.input = input_params
+        self.created = time.monotonic()
+        self.latency = max(0.0, random.gauss(backend.latency, backend.jitter))
+        self.status = "starting"
+        self.output = None
+        self.error = None
+
+    def reload(self):
+        if self.status in ("succeeded", "failed", "canceled"):
+            return
+        if time.monotonic() - self.created < self.latency:
+            self.status = "processing"
+            return
+        roll = random.random()
+        if roll < self.backend.nsfw_rate:
+            self.status, self.error = "failed", "NSFW content detected. Try running it again, or try a different prompt."
+        elif roll < self.backend.nsfw_rate + self.backend.error_rate:
+            self.status, self.error = "failed", "fake model error"
+        else:
+            color = tuple(random.randrange(256) for _ in range(3))
+            out = io.BytesIO()
+            Image.new("RGB", (512, 512), color).save(out, format="PNG")
+            self.status = "succeeded"
+            self.output = ["data:image/png;base64," + base64.b64encode(out.getvalue()).decode("ascii")]
+
+    def cancel(self):
+        if self.status not in ("succeeded", "failed", "canceled"):
+            self.status = "canceled"
+            self.backend.cancelled.append(self.id)
+
+
+class FakeReplicate:
+    """Stand-in for `replicate.models` and `replicate.predictions`."""
+
+    def __init__(self, latency, jitter, error_rate, nsfw_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.nsfw_rate = nsfw_rate
+        self.ids = itertools.count()
+        self.created = [] # prediction ids; list appends are thread-safe
+        self.cancelled = []
+        # replicate.models.get(name).versions.get(id) -> a version handle
+        self.versions = self
+
+    def get(self, name):
+        return self
+
+    def create(self, version=None, input=None, **kwargs):
+        prediction = FakePrediction(self, input)
+        self.created.append(prediction.id)
+        return prediction
+
+
+class _NullPlaceholder:
+    def markdown(self, text):
+        pass
+
+
+def percentiles(values):
+    """p50/p95/p99 (nearest rank) plus count and mean, in seconds."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+    }
+
+
+def run_session(session_id, rounds, results):
+    """Plays one story through the same steps app.py takes per round."""
+    from scheduler import PRIORITY_TEXT, admission
+    from story_context import StoryContext
+    from streaming import StreamRenderer
+    from utils import generate_continuation_stream, generate_initial_plot_blocking, submit_comic_image
+
+    character, theme, description = f"Hero {session_id}", "Survival", "Nature shows no mercy."
+    story_history, panels = [], []
+
+    def track_panel(future, submitted):
+        future.add_done_callback(lambda f: results["panel"].append(time.perf_counter() - submitted))
+        panels.append(future)
+
+    started = time.perf_counter()
+    plot = generate_initial_plot_blocking(character, theme, description)
+    results["opening"].append(time.perf_counter() - started)
+    story_history.append({"type": "plot", "content": plot})
+    track_panel(submit_comic_image(plot, character=character, theme=theme), time.perf_counter())
+
+    context = StoryContext()
+    for round_number in range(1, rounds + 1):
+        action = f"{character} climbs higher in round {round_number}."
+        story_history.append({"type": "user", "character_name": character, "content": action})
+        started = time.perf_counter()
+        # Same order as app.py: build the prompt, then wait for an OpenAI slot
+        history_for_prompt = context.build([item["content"] for item in story_history[:-1]])
+        ticket = admission.request("openai", PRIORITY_TEXT)
+        ticket.wait()
+        renderer = StreamRenderer(_NullPlaceholder())
+        first_token = None
+        for chunk in generate_continuation_stream(history_for_prompt, action, character, theme, description, ticket=ticket):
+            if first_token is None:
+                first_token = time.perf_counter()
+                results["ttft"].append(first_token - started)
+            renderer.feed(chunk)
+        reply = renderer.finish()
+        results["round"].append(time.perf_counter() - started)
+        results["frames"].append(renderer.frames)
+        if not reply:
+            results["empty_replies"].append(round_number)
+        story_history.append({"type": "ai", "content": reply})
+        context.schedule_summary([item["content"] for item in story_history])
+        track_panel(submit_comic_image(reply, character=character, theme=theme), time.perf_counter())
+
+    for future in panels:
+        outcome = future.result()
+        if not outcome or outcome.startswith("error_"):
+            results["missing_panels"].append(outcome)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent simulated sessions")
+    parser.add_argument("--rounds", type=int, default=10, help="player rounds per session")
+    parser.add_argument("--ttft", type=float, default=0.5, help="fake LLM time to first token (s)")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="fake LLM tokens per second")
+    parser.add_argument("--tokens", type=int, default=90, help="tokens per fake LLM reply")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--image-latency", type=float, default=6.0, help="mean fake image latency (s)")
+    parser.add_argument("--image-jitter", type=float, default=2.0, help="std dev of fake image latency (s)")
+    parser.add_argument("--image-error-rate", type=float, default=0.02)
+    parser.add_argument("--nsfw-rate", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    # Keep benchmark panels out of the real store and skip the warm pool
+    os.environ.setdefault("PANEL_STORE_DIR", tempfile.mkdtemp(prefix="bench-panels-"))
+    os.environ.setdefault("WARM_POOL_SIZE", "0")
+
+    import replicate
+    import utils
+
+    utils.set_llm(FakeChatModel(ttft=args.ttft, token_rate=args.token_rate, tokens=args.tokens, error_rate=args.llm_error_rate))
+    fake_replicate = FakeReplicate(args.image_latency, args.image_jitter, args.image_error_rate, args.nsfw_rate)
+    replicate.models = replicate.predictions = fake_replicate
+
+    # Lists only: appends are safe across session threads
+    results = {"opening": [], "ttft": [], "round": [], "panel": [], "frames": [], "missing_panels": [], "empty_replies": []}
+    thread_samples = []
+    done = threading.Event()
+
+    def sample_threads():
+        while not done.wait(0.1):
+            thread_samples.append(threading.active_count())
+
+    tracemalloc.start()
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    # One thread per session, as Streamlit runs each session's script in its own thread
+    with ThreadPoolExecutor(max_workers=args.sessions) as sessions:
+        for future in [sessions.submit(run_session, i, args.rounds, results) for i in range(args.sessions)]:
+            future.result()
+    wall_time = time.perf_counter() - started
+    done.set()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    report = {
+        "config": vars(args),
+        "wall_time_s": wall_time,
+        "time_to_first_token_s": percentiles(results["ttft"]),
+        "opening_latency_s": percentiles(results["opening"]),
+        "round_latency_s": percentiles(results["round"]),
+        "panel_latency_s": percentiles(results["panel"]),
+        "frames_per_reply": percentiles(results["frames"]),
+        "missing_panels": len(results["missing_panels"]),
+        "image_predictions": {"created": len(fake_replicate.created), "cancelled": len(fake_replicate.cancelled)},
+        "empty_replies": len(results["empty_replies"]),
+        "threads": {"max": max(thread_samples, default=threading.active_count()), "samples": len(thread_samples)},
+        "peak_memory_per_session_bytes": peak_memory // max(args.sessions, 1),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
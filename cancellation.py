@@ -0,0 +1,125 @@
+"""Cancellation of generation work a session no longer needs.
+
+Each session keeps a CancelScope in `st.session_state`. The LLM streams, panel
+jobs and summaries started for the session carry a CancelToken from it and are
+aborted when that token is cancelled:
+- the story is reset ("Start a New Story", or a new story replaces it);
+- a newer request for the same stage supersedes an older one still running;
+- the session is abandoned, i.e. its state is dropped without a reset.
+Streams stop their HTTP request and Replicate predictions are cancelled, so
+quota and worker capacity go to stories someone is still reading. Cancelled
+calls and the provider time they saved are counted in `metrics`.
+"""
+import asyncio
+import threading
+import weakref
+
+from metrics import metrics
+
+
+class Cancelled(Exception):
+    """The work's cancel token was cancelled."""
+
+
+class CancelToken:
+    """Thread-safe cancellation flag with callbacks; cancelled along with `parent`."""
+
+    def __init__(self, parent=None):
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        if parent is not None:
+            parent.add_callback(lambda: self.cancel(parent.reason))
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        """Cancels the token and runs its callbacks. Safe to call twice."""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback failed: {e}")
+
+    def add_callback(self, callback):
+        """Calls `callback()` on cancellation (right away if already cancelled).
+
+        Returns a function that unregisters the callback, for work that
+        finished without being cancelled.
+        """
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def check(self):
+        """Raises Cancelled if the token was cancelled."""
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+    def wait(self, timeout):
+        """Sleeps up to `timeout` seconds; returns True early if the token is cancelled."""
+        return self._event.wait(timeout)
+
+    async def race(self, awaitable):
+        """Awaits `awaitable`, raising Cancelled if the token is cancelled first."""
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(awaitable)
+        forget = self.add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if self.cancelled:
+                raise Cancelled(self.reason) from None
+            raise
+        finally:
+            forget()
+
+    def _discard(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+class CancelScope:
+    """The cancel tokens of one session."""
+
+    def __init__(self):
+        self.root = CancelToken()
+        self._latest = {} # stage -> token of its newest request
+        # Dropping an abandoned session's state collects the scope, which cancels its work
+        weakref.finalize(self, self.root.cancel, "abandoned")
+
+    def token(self, stage=None):
+        """A token for one request, cancelled with the session.
+
+        Asking again for the same `stage` supersedes the previous request,
+        which is cancelled if it is still running.
+        """
+        token = CancelToken(self.root)
+        if stage is not None:
+            previous, self._latest[stage] = self._latest.get(stage), token
+            if previous is not None:
+                previous.cancel("superseded")
+        return token
+
+    def cancel(self, reason="reset"):
+        """Cancels all of the session's work."""
+        self.root.cancel(reason)
+
+
+def record_cancelled(token, backend, elapsed, expected, **labels):
+    """Counts a cancelled provider call and the time it would still have taken."""
+    metrics.inc("cancelled_calls_total", backend=backend, reason=token.reason, **labels)
+    metrics.inc("cancelled_seconds_saved_total", max(expected - elapsed, 0.0), backend=backend, **labels)
@@ -0,0 +1,155 @@
+"""Comic pages: panels composited into 2x2 sheets with captions.
+
+Pages are drawn with Pillow from the panel store's thumbnails. Finished
+pages are cached on disk as WebP (or JPEG) under a hash of what is on them:
+the panels' state, their captions and the layout. A page that still has a
+panel drawing is short-lived, so it is drawn in memory and never written.
+When a panel finishes, only the page it lands on is redrawn; every other
+page is served from the cache. The UI shows one image per page instead of
+one per panel, and the PDF export embeds the same files.
+"""
+import hashlib
+import io
+import json
+import os
+import textwrap
+import threading
+from concurrent.futures import Future
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+from image_prompts import split_sentences
+from panel_store import PANEL_THUMBNAIL_SIZE, panel_store, write_atomic
+
+COMIC_PAGE_DIR = os.getenv("COMIC_PAGE_DIR", ".comic_pages")
+COMIC_PAGE_FORMAT = os.getenv("COMIC_PAGE_FORMAT", "WEBP").upper() # or JPEG
+COMIC_PAGE_QUALITY = int(os.getenv("COMIC_PAGE_QUALITY", "80"))
+COMIC_PAGE_CELL = int(os.getenv("COMIC_PAGE_CELL", str(PANEL_THUMBNAIL_SIZE))) # panel size in pixels
+PANELS_PER_PAGE = 4
+CAPTION_MAX_CHARS = 120
+
+_COLUMNS = 2
+_GUTTER = 16
+_FONT_SIZE = 15
+_CAPTION_LINES = 3
+_BACKGROUND = (255, 255, 255)
+_EMPTY_CELL = (235, 238, 244)
+_TEXT = (40, 40, 40)
+
+# What an unfinished or failed panel shows instead of a picture
+_MESSAGES = {
+    "pending": "Drawing panel {n}...",
+    "error_nsfw": "Panel {n} was a bit too graphic to draw",
+    "error_timeout": "Panel {n} took too long to draw",
+    "error": "Couldn't draw panel {n}",
+    "none": "Panel {n} could not be generated",
+    "remote": "Open full size to see panel {n}",
+    "missing": "Panel {n} isn't available on this server",
+}
+
+_font = None
+_font_lock = threading.Lock()
+
+
+def _get_font():
+    global _font
+    with _font_lock:
+        if _font is None:
+            try:
+                _font = ImageFont.truetype("DejaVuSans.ttf", _FONT_SIZE)
+            except OSError: # no TrueType font installed; Pillow's bitmap font still works
+                _font = ImageFont.load_default()
+    return _font
+
+
+def panel_captions(story_history):
+    """One caption per panel: the opening sentence of the passage it illustrates."""
+    captions = []
+    for entry in story_history:
+        if entry["type"] in ("plot", "ai"):
+            sentence = (split_sentences(" ".join(entry["content"].split())) or [""])[0]
+            captions.append(textwrap.shorten(sentence, CAPTION_MAX_CHARS, placeholder="..."))
+    return captions
+
+
+def _panel_state(panel):
+    """What a panel slot shows: its panel_store key, or one of the _MESSAGES kinds."""
+    if isinstance(panel, Future):
+        return "pending"
+    if panel_store.has(panel):
+        return panel
+    if not panel:
+        return "none"
+    if panel in ("error_nsfw", "error_timeout"):
+        return panel
+    if panel.startswith("error_"):
+        return "error"
+    if panel.startswith(("http://", "https://")):
+        return "remote" # a remote URL the store could not keep a copy of
+    return "missing" # a panel key from a store this process can't read
+
+
+def render_page(panels, captions, page_index):
+    """Returns the composited page for up to PANELS_PER_PAGE panels.
+
+    `panels` are image_urls-style slots: panel keys, Futures still rendering,
+    "error_*" markers, None or remote URLs. A finished page comes back as the
+    path of its cached file, so an unchanged page costs a hash and a stat. A
+    page with a panel still rendering comes back as image bytes.
+    """
+    captions = list(captions) + [""] * (len(panels) - len(captions))
+    cells = [(_panel_state(panel), caption) for panel, caption in zip(panels, captions)]
+    if any(state == "pending" for state, _ in cells):
+        return _compose(cells, page_index * PANELS_PER_PAGE)
+    layout = [COMIC_PAGE_CELL, COMIC_PAGE_FORMAT, COMIC_PAGE_QUALITY, page_index]
+    key = hashlib.sha256(json.dumps([layout, cells]).encode("utf-8")).hexdigest()
+    extension = "webp" if COMIC_PAGE_FORMAT == "WEBP" else "jpg"
+    path = os.path.join(COMIC_PAGE_DIR, key[:2], f"{key}.{extension}")
+    if not os.path.exists(path):
+        write_atomic(path, _compose(cells, page_index * PANELS_PER_PAGE))
+    return path
+
+
+def story_pages(story_history, panels):
+    """Every page of the story (see render_page), drawing only the ones that changed."""
+    captions = panel_captions(story_history)
+    return [
+        render_page(panels[first:first + PANELS_PER_PAGE], captions[first:first + PANELS_PER_PAGE], first // PANELS_PER_PAGE)
+        for first in range(0, len(panels), PANELS_PER_PAGE)
+    ]
+
+
+def _compose(cells, first_number):
+    font = _get_font()
+    line_height = _FONT_SIZE + 5
+    chars_per_line = max(10, int(COMIC_PAGE_CELL / (_FONT_SIZE * 0.55)))
+    caption_height = _CAPTION_LINES * line_height + _GUTTER // 2
+    rows = (len(cells) + _COLUMNS - 1) // _COLUMNS
+    width = _COLUMNS * COMIC_PAGE_CELL + (_COLUMNS + 1) * _GUTTER
+    height = rows * (COMIC_PAGE_CELL + caption_height + _GUTTER) + _GUTTER
+    page = Image.new("RGB", (width, height), _BACKGROUND)
+    draw = ImageDraw.Draw(page)
+
+    for i, (state, caption) in enumerate(cells):
+        x = _GUTTER + (i % _COLUMNS) * (COMIC_PAGE_CELL + _GUTTER)
+        y = _GUTTER + (i // _COLUMNS) * (COMIC_PAGE_CELL + caption_height + _GUTTER)
+        number = first_number + i + 1
+        if state in _MESSAGES:
+            draw.rectangle([x, y, x + COMIC_PAGE_CELL - 1, y + COMIC_PAGE_CELL - 1], fill=_EMPTY_CELL)
+            message = "\n".join(textwrap.wrap(_MESSAGES[state].format(n=number), chars_per_line))
+            draw.multiline_text((x + _GUTTER, y + COMIC_PAGE_CELL // 2 - line_height), message, fill=_TEXT, font=font)
+        else:
+            with Image.open(io.BytesIO(panel_store.thumbnail(state))) as panel:
+                panel = ImageOps.fit(panel.convert("RGB"), (COMIC_PAGE_CELL, COMIC_PAGE_CELL))
+            page.paste(panel, (x, y))
+        draw.rectangle([x, y, x + COMIC_PAGE_CELL - 1, y + COMIC_PAGE_CELL - 1], outline=_TEXT, width=2)
+        lines = textwrap.wrap(caption, chars_per_line)[:_CAPTION_LINES]
+        for line_number, line in enumerate(lines):
+            draw.text((x, y + COMIC_PAGE_CELL + 4 + line_number * line_height), line, fill=_TEXT, font=font)
+
+    out = io.BytesIO()
+    if COMIC_PAGE_FORMAT == "WEBP":
+        page.save(out, format="WEBP", quality=COMIC_PAGE_QUALITY, method=4)
+    else:
+        page.save(out, format="JPEG", quality=COMIC_PAGE_QUALITY, optimize=True)
+    return out.getvalue()
@@ -0,0 +1,241 @@
+"""Resilient calls to the Replicate image model.
+
+Instead of a bare `replicate.run`, predictions are created and polled so that:
+- every panel has a deadline, and predictions past it are cancelled. The
+  clock starts once a prediction is processing, so a cold-booting model
+  only has to come up within IMAGE_STARTUP_SECONDS;
+- transient failures (connection errors, 429/5xx responses, and model
+  failures known to pass, like running out of GPU memory) are retried with
+  jittered exponential backoff; anything else fails the panel right away,
+  since another paid prediction would fail the same way;
+- a slow prediction can be hedged with a second one once it runs past the
+  recent latency percentile, keeping whichever finishes first;
+- a prompt rejected as NSFW is retried once in a toned-down form;
+- a cancelled panel (see cancellation) stops polling and cancels its predictions.
+
+replicate and requests are imported on first use (or by the warm-up).
+"""
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from cancellation import CancelToken, Cancelled, record_cancelled
+from metrics import metrics
+from scheduler import PRIORITY_BACKGROUND, admission
+
+IMAGE_MODEL = "iwasrobbed/sdxl-suspense:2717cb6a3d2505d13e1e05ba16cbfe188f86609b9060b785220d3c30cefe6242"
+IMAGE_DEADLINE_SECONDS = float(os.getenv("IMAGE_DEADLINE_SECONDS", "120")) # once processing
+IMAGE_STARTUP_SECONDS = float(os.getenv("IMAGE_STARTUP_SECONDS", "300")) # to start processing, incl. cold boot
+IMAGE_MAX_ATTEMPTS = int(os.getenv("IMAGE_MAX_ATTEMPTS", "3"))
+IMAGE_BACKOFF_SECONDS = float(os.getenv("IMAGE_BACKOFF_SECONDS", "1"))
+IMAGE_POLL_SECONDS = float(os.getenv("IMAGE_POLL_SECONDS", "0.5"))
+IMAGE_HEDGE_PERCENTILE = float(os.getenv("IMAGE_HEDGE_PERCENTILE", "90")) # 0 disables hedging
+IMAGE_HEDGE_MIN_SAMPLES = 20
+
+# Prediction errors that tend to go away on a retry
+_TRANSIENT_MODEL_ERRORS = re.compile(
+    r"out of memory|cuda error|timed? ?out|temporarily|unavailable|internal server error|connection (reset|refused|error)",
+    re.IGNORECASE,
+)
+_HTTP_STATUS = re.compile(r"\b([45]\d\d)\b")
+
+# Words that commonly trip the NSFW filter in story text, and milder stand-ins
+_SANITIZE = {
+    r"\bblood(y|ied)?\b": "",
+    r"\bgor(e|y)\b": "",
+    r"\b(kill(s|ed|ing)?|murder(s|ed|ing)?|slaughter(s|ed|ing)?)\b": "defeat",
+    r"\b(dead|dying|corpses?|bodies)\b": "fallen",
+    r"\b(stab(s|bed|bing)?|slash(es|ed|ing)?)\b": "strike",
+    r"\b(wound(s|ed)?|injur(y|ies|ed))\b": "bruise",
+    r"\b(guns?|knife|knives|blades?)\b": "gadget",
+    r"\b(naked|nude)\b": "",
+}
+
+
+class ImageTimeout(Exception):
+    """The panel missed its deadline."""
+
+
+def sanitize_prompt(prompt):
+    """Tones down words that tend to trip the image model's NSFW filter."""
+    for pattern, replacement in _SANITIZE.items():
+        prompt = re.sub(pattern, replacement, prompt, flags=re.IGNORECASE)
+    return re.sub(r"\s{2,}", " ", prompt).strip() + ", family-friendly comic art"
+
+
+def _is_nsfw(error):
+    return "NSFW content detected" in str(error)
+
+
+def _http_status(error):
+    """The HTTP status behind an API error, if it can be told."""
+    status = getattr(error, "status", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # replicate 0.8 only puts the status in the message, e.g. "HTTP error: (503, ...)"
+        match = _HTTP_STATUS.search(str(error))
+        status = match and match.group(1)
+    return int(status) if status else None
+
+
+def _is_transient(error):
+    """Whether `error` is worth paying for another prediction."""
+    import requests
+    from replicate.exceptions import ModelError, ReplicateError
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError)):
+        return True
+    if isinstance(error, ModelError): # the prediction itself failed
+        return bool(_TRANSIENT_MODEL_ERRORS.search(str(error)))
+    if isinstance(error, (ReplicateError, requests.HTTPError)):
+        status = _http_status(error)
+        return status is not None and (status == 429 or status >= 500)
+    return False
+
+
+class ImageClient:
+    """Runs image predictions with deadlines, retries and optional hedging."""
+
+    def __init__(self, model=IMAGE_MODEL, deadline=IMAGE_DEADLINE_SECONDS, max_attempts=IMAGE_MAX_ATTEMPTS,
+                 backoff=IMAGE_BACKOFF_SECONDS, poll=IMAGE_POLL_SECONDS, hedge_percentile=IMAGE_HEDGE_PERCENTILE,
+                 startup=IMAGE_STARTUP_SECONDS):
+        self.model = model
+        self.deadline = deadline
+        self.startup = startup
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll = poll
+        self.hedge_percentile = hedge_percentile
+        self._latencies = deque(maxlen=200) # recent successful prediction times
+        self._version = None
+        self._lock = threading.Lock()
+
+    def run(self, input_params, cancel_token=None, labels=None):
+        """Returns the model output for `input_params`, like `replicate.run`.
+
+        Raises ModelError for NSFW prompts (after one toned-down retry), for
+        failures that aren't transient and for transient ones that persist
+        across every attempt; ImageTimeout; or Cancelled once `cancel_token`
+        is cancelled.
+        """
+        cancel_token = cancel_token or CancelToken() # nobody else can cancel a fresh token
+        started = time.monotonic()
+        try:
+            return self._run_with_retries(input_params, cancel_token)
+        except Cancelled:
+            record_cancelled(cancel_token, "replicate", time.monotonic() - started, self.typical_seconds(), **(labels or {}))
+            raise
+
+    def _run_with_retries(self, input_params, cancel_token):
+        sanitized = False
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self._run_hedged(input_params, cancel_token)
+            except (Cancelled, ImageTimeout):
+                raise
+            except Exception as e:
+                if _is_nsfw(e) and not sanitized:
+                    # A toned-down prompt is a new request, not a retry of a transient error
+                    sanitized = True
+                    attempt -= 1
+                    input_params = {**input_params, "prompt": sanitize_prompt(input_params["prompt"])}
+                    metrics.inc("panel_retries_total", reason="nsfw")
+                    continue
+                if _is_nsfw(e) or not _is_transient(e) or attempt >= self.max_attempts:
+                    raise
+            # Full jitter keeps retries from many sessions from lining up
+            delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+            metrics.inc("panel_retries_total", reason="transient")
+            cancel_token.wait(delay) # wakes early if cancelled
+
+    def hedge_after(self):
+        """Seconds after which a prediction gets a hedge, or None if not enough data yet."""
+        if not self.hedge_percentile:
+            return None
+        with self._lock:
+            if len(self._latencies) < IMAGE_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    def typical_seconds(self):
+        """Median recent prediction time, or 0 before any prediction finished."""
+        with self._lock:
+            ordered = sorted(self._latencies)
+        return ordered[len(ordered) // 2] if ordered else 0.0
+
+    def prewarm(self):
+        """Looks up the model version, opening the connection to Replicate ahead of the first panel."""
+        self._get_version()
+
+    def _get_version(self):
+        if self._version is None:
+            import replicate
+            model_name, version_id = self.model.split(":")
+            self._version = replicate.models.get(model_name).versions.get(version_id)
+        return self._version
+
+    def _create(self, input_params):
+        import replicate
+        return replicate.predictions.create(version=self._get_version(), input=input_params)
+
+    def _run_hedged(self, input_params, cancel_token):
+        from replicate.exceptions import ModelError
+        cancel_token.check()
+        started = time.monotonic()
+        # Until a prediction is processing only the startup allowance applies
+        deadline = started + self.startup
+        processing = False
+        running = [self._create(input_params)]
+        hedge_after = self.hedge_after()
+        hedge_ticket = None
+        last_error = None
+        try:
+            while running:
+                cancel_token.check()
+                now = time.monotonic()
+                if now >= deadline:
+                    raise ImageTimeout(f"prediction still {running[0].status} at the deadline")
+                if hedge_after is not None and now - started >= hedge_after:
+                    # Hedges only run on spare capacity, never ahead of real panels
+                    if hedge_ticket is None:
+                        hedge_ticket = admission.request("replicate", PRIORITY_BACKGROUND)
+                    elif hedge_ticket.granted:
+                        running.append(self._create(input_params))
+                        metrics.inc("panel_hedges_total")
+                        hedge_after = None
+                for prediction in list(running):
+                    prediction.reload()
+                    if not processing and prediction.status in ("processing", "succeeded"):
+                        processing = True
+                        deadline = time.monotonic() + self.deadline
+                    if prediction.status == "succeeded":
+                        running.remove(prediction)
+                        with self._lock:
+                            self._latencies.append(time.monotonic() - started)
+                        return prediction.output
+                    if prediction.status in ("failed", "canceled"):
+                        running.remove(prediction)
+                        last_error = ModelError(prediction.error)
+                if running:
+                    cancel_token.wait(self.poll)
+            raise last_error
+        finally:
+            for prediction in running:
+                self._cancel(prediction)
+            if hedge_ticket is not None:
+                hedge_ticket.release()
+
+    @staticmethod
+    def _cancel(prediction):
+        try:
+            prediction.cancel()
+        except Exception as e:
+            print(f"Could not cancel prediction {prediction.id}: {e}")
+
+
+# Shared by every panel job in this process
+image_client = ImageClient()
@@ -0,0 +1,117 @@
+"""Distills story passages into compact prompts for the image model.
+
+A plot or AI reply is 60-120 words of prose, much of it dialogue and
+narration the image model can't draw, and past its text encoder's 77-token
+window. Each passage is cut down to its most visual sentences and their
+content words, then framed with the character's look and the theme's art
+style. The character's look is derived from the character and theme alone,
+so every panel of a story describes the hero the same way.
+
+Everything here is deterministic: the same passage, character and theme
+always give the same prompt. The prompt keeps the story's own casing and
+script; panel_cache keys on its normalize_prompt() form.
+"""
+import hashlib
+import os
+import re
+
+IMAGE_PROMPT_MAX_WORDS = int(os.getenv("IMAGE_PROMPT_MAX_WORDS", "30")) # scene words, before framing
+
+THEME_STYLES = {
+    "Final Destination": "tense suspense, dramatic shadows, near miss",
+    "Survival": "harsh wilderness, gritty survival, stormy light",
+    "Superhero Tale": "bold superhero action, city skyline, dynamic pose",
+    "Fantasy Adventure": "epic fantasy, glowing magic, ancient ruins",
+    "Mystery": "noir mystery, moody lamplight, hidden clues",
+    "Slice of Life": "warm everyday life, soft daylight, cozy details",
+    "Sci-Fi Journey": "sleek science fiction, neon starship interior, distant planets",
+}
+
+_BUILDS = ("tall", "wiry", "broad-shouldered", "short", "athletic", "lanky")
+_HAIR = ("short black hair", "long red hair", "messy brown hair", "silver hair", "curly blond hair", "a shaved head")
+_OUTFITS = {
+    "Final Destination": ("a grey hoodie", "a denim jacket", "a rumpled office shirt"),
+    "Survival": ("a torn field jacket", "a muddy rain poncho", "hiking gear"),
+    "Superhero Tale": ("a masked blue suit", "a red caped costume", "a black armored suit"),
+    "Fantasy Adventure": ("a hooded green cloak", "leather armor", "flowing mage robes"),
+    "Mystery": ("a long trench coat", "a tweed jacket", "a dark turtleneck"),
+    "Slice of Life": ("a cozy sweater", "a school uniform", "a coffee-stained apron"),
+    "Sci-Fi Journey": ("a white flight suit", "a patched space suit", "a sleek pilot jacket"),
+}
+_DEFAULT_OUTFITS = ("a weathered jacket", "simple traveling clothes", "a long coat")
+
+# Words that carry no picture; dropped from the scene
+_STOPWORDS = frozenset("""
+a an the and or but so yet nor of to in on at by for with from as into onto upon about
+is are was were be been being am has have had do does did will would can could should may might must
+it its this that these those there here then than too very just really quite also even still
+i me my we us our you your he him his she her they them their who whom whose which what when where why how
+not no all any each every some such own same other only again ever never now soon suddenly already
+says said asks asked replies replied thinks thought knows knew feels felt seems seemed wonders
+""".split())
+
+# Concrete, drawable words that make a sentence worth keeping
+_VISUAL_WORDS = frozenset("""
+light dark shadow shadows fire flames smoke storm rain snow fog mist thunder lightning sun moon stars sky
+city street alley rooftop tower castle forest cave river sea ocean mountain desert ship station door window
+bridge car train crowd monster dragon robot creature sword glowing broken falling running jumping climbing
+flying burning explodes explosion crashes collapses giant tiny ancient neon
+""".split())
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])\s*")
+_DIALOGUE = re.compile(r"\"[^\"]*\"|“[^”]*”|「[^」]*」")
+_WORD = re.compile(r"[^\W\d_][\w'-]*") # any script, so names like José or 李明 survive
+
+
+def character_description(character, theme):
+    """A fixed look for `character` in `theme`, the same for every panel of the story."""
+    seed = int(hashlib.sha256(f"{character}|{theme}".encode("utf-8")).hexdigest(), 16)
+    build = _BUILDS[seed % len(_BUILDS)]
+    hair = _HAIR[(seed // 7) % len(_HAIR)]
+    outfits = _OUTFITS.get(theme, _DEFAULT_OUTFITS)
+    outfit = outfits[(seed // 49) % len(outfits)]
+    return f"{build} with {hair}, wearing {outfit}"
+
+
+def _visual_score(sentence, character):
+    words = [word.casefold() for word in _WORD.findall(sentence)]
+    content = [word for word in words if word not in _STOPWORDS]
+    score = len(content) + 2 * sum(word in _VISUAL_WORDS for word in content)
+    if character and character.casefold() in sentence.casefold():
+        score += 3 # the hero doing something is the panel
+    return score
+
+
+def split_sentences(text):
+    """The sentences of `text`, split after ., !, ? and their full-width forms."""
+    return [sentence for sentence in _SENTENCE_SPLIT.split(text.strip()) if sentence]
+
+
+def distill_scene(passage, character=None, max_words=IMAGE_PROMPT_MAX_WORDS):
+    """The content words of the passage's two most visual sentences, in story order."""
+    sentences = split_sentences(_DIALOGUE.sub(" ", passage))
+    ranked = sorted(range(len(sentences)), key=lambda i: (-_visual_score(sentences[i], character), i))
+    chosen = " ".join(sentences[i] for i in sorted(ranked[:2]))
+    words = [word for word in _WORD.findall(chosen) if word.casefold() not in _STOPWORDS]
+    return " ".join(words[:max_words])
+
+
+def normalize_prompt(prompt):
+    """Casefolds, strips punctuation and drops repeated phrases, so equal prompts compare equal."""
+    phrases = []
+    for phrase in re.sub(r"[^\w,'\- ]+", " ", prompt.casefold()).split(","):
+        phrase = " ".join(phrase.split())
+        if phrase and phrase not in phrases:
+            phrases.append(phrase)
+    return ", ".join(phrases)
+
+
+def build_image_prompt(passage, character=None, theme=None):
+    """The visual prompt for one story passage, as sent to the image model."""
+    parts = []
+    if character:
+        parts.append(f"{character}, {character_description(character, theme)}")
+    parts.append(distill_scene(passage, character))
+    if theme in THEME_STYLES:
+        parts.append(THEME_STYLES[theme])
+    return ", ".join(part for part in parts if part)
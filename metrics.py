@@ -0,0 +1,173 @@
+"""In-process latency metrics for the story pipeline.
+
+Counters and histograms are kept in memory, labelled by stage tags such as
+theme and round, and cost a dict update per observation. They can be read in
+two ways, both off unless configured:
+
+- METRICS_PORT: serve the Prometheus text format at http://<host>:<port>/metrics
+- METRICS_FILE: append every observation as a JSON line to a size-rotated file
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_FILE_MAX_BYTES = int(os.getenv("METRICS_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# Upper bounds shared by every histogram; wide enough for token counts and seconds
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 250, 500, 1000, 2500, 5000)
+
+_HELP = {
+    "prompt_tokens": "Prompt size in tokens",
+    "prompt_static_tokens": "Prompt tokens before the first variable, shared by every request",
+    "prompt_story_prefix_tokens": "Prompt tokens before the story history, shared by every round of a story",
+    "story_history_reused_tokens": "Story history tokens shared with the previous round's prompt (cacheable)",
+    "llm_time_to_first_token_seconds": "Time from LLM request to first streamed token",
+    "llm_seconds": "Total LLM generation time",
+    "llm_tokens_per_second": "Streamed tokens per second after the first token",
+    "stream_frames": "Placeholder repaints per streamed reply",
+    "replicate_queue_seconds": "Time a panel job waited before starting",
+    "replicate_run_seconds": "Time spent inside the image model call",
+    "panel_store_seconds": "Time to download and store a finished panel",
+    "panel_cache_total": "Panel requests served from (hit) or missing in (miss) the panel result cache",
+    "script_runs_total": "Streamlit script runs (reruns) per round",
+    "cancelled_calls_total": "Provider calls cancelled because nobody needed the result any more",
+    "cancelled_seconds_saved_total": "Estimated provider seconds saved by cancelled calls",
+    "cold_start_seconds": "Time from process start to each import, warm-up step and first request",
+}
+
+
+class Metrics:
+    """Thread-safe counters and histograms keyed by (name, labels)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+        self._log = None
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        self._write(name, amount, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [0] * (len(_BUCKETS) + 2)
+            state[bisect.bisect_left(_BUCKETS, value)] += 1
+            state[-2] += value
+            state[-1] += 1
+        self._write(name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the wall time of the `with` block, in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def log_to(self, path, max_bytes=METRICS_FILE_MAX_BYTES, backups=3):
+        """Also writes every observation to a rotating JSON-lines file."""
+        log = logging.getLogger("metrics.file")
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        log.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups))
+        self._log = log
+
+    def _write(self, name, value, labels):
+        if self._log is not None:
+            self._log.info(json.dumps({"ts": time.time(), "metric": name, "value": value, **labels}))
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(state) for key, state in self._histograms.items()}
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines += _header(name, "counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines += _header(name, "histogram")
+            for (metric, labels), state in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(_BUCKETS + ("+Inf",), state[:-2]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {state[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {state[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{key}="{_escape(value)}"' for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _header(name, kind):
+    return [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} {kind}"]
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes would otherwise flood the server log
+
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def start_exporters(port=METRICS_PORT, path=METRICS_FILE):
+    """Starts the configured exporters once per process."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+        if path:
+            metrics.log_to(path)
+        if port:
+            server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+
+# Shared by every module in this process
+metrics = Metrics()
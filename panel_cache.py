@@ -0,0 +1,68 @@
+"""Finished panels by image prompt, so identical requests skip the model.
+
+Entries are keyed by the normalized image prompt plus the model version and
+point at panels in panel_store. A retried panel, a regenerated story or a
+warm-pool opening whose prompt was drawn before gets the stored panel back
+instead of paying for another prediction. The cache holds at most
+PANEL_RESULT_CACHE_ENTRIES entries, evicting the least recently used, and
+entries expire after PANEL_RESULT_CACHE_TTL_SECONDS.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from image_prompts import normalize_prompt
+from metrics import metrics
+from panel_store import panel_store
+
+PANEL_RESULT_CACHE_ENTRIES = int(os.getenv("PANEL_RESULT_CACHE_ENTRIES", "2048")) # 0 disables the cache
+PANEL_RESULT_CACHE_TTL_SECONDS = float(os.getenv("PANEL_RESULT_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+
+class PanelCache:
+    """LRU with TTL of (prompt, model) -> panel_store key."""
+
+    def __init__(self, max_entries=PANEL_RESULT_CACHE_ENTRIES, ttl=PANEL_RESULT_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (panel key, stored at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt, model):
+        return hashlib.sha256(f"{model}\n{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def get(self, prompt, model):
+        """The stored panel key for `prompt` on `model`, or None."""
+        if not self.max_entries:
+            return None
+        key = self.key(prompt, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        # The store may have been cleaned up underneath the cache
+        if entry is None or not panel_store.has(entry[0]):
+            metrics.inc("panel_cache_total", result="miss")
+            return None
+        metrics.inc("panel_cache_total", result="hit")
+        return entry[0]
+
+    def put(self, prompt, model, panel_key):
+        if not self.max_entries:
+            return
+        key = self.key(prompt, model)
+        with self._lock:
+            self._entries[key] = (panel_key, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# Shared by every session in this process
+panel_cache = PanelCache()
@@ -0,0 +1,94 @@
+"""Local, content-addressed storage for comic panels.
+
+Replicate hands back short-lived URLs. Each panel is downloaded once, stored on
+disk under the SHA-256 of its bytes, and given a compressed JPEG thumbnail.
+Comic pages are composited from the thumbnails, full resolution is loaded
+only on request, and recently used images stay in an in-memory LRU.
+"""
+import hashlib
+import io
+import os
+import threading
+import urllib.request
+from collections import OrderedDict
+
+from PIL import Image
+
+PANEL_STORE_DIR = os.getenv("PANEL_STORE_DIR", ".panel_store")
+PANEL_THUMBNAIL_SIZE = int(os.getenv("PANEL_THUMBNAIL_SIZE", "384"))
+PANEL_CACHE_ITEMS = int(os.getenv("PANEL_CACHE_ITEMS", "128"))
+
+
+def write_atomic(path, data):
+    """Writes `data` to `path` through a rename, so readers never see a half-written file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class PanelStore:
+    """Panels on disk keyed by content hash, with an LRU of their bytes."""
+
+    def __init__(self, root=PANEL_STORE_DIR, thumbnail_size=PANEL_THUMBNAIL_SIZE, cache_items=PANEL_CACHE_ITEMS):
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        self.cache_items = cache_items
+        self._cache = OrderedDict() # (key, thumbnail) -> bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def put_url(self, url, timeout=60):
+        """Downloads an image once and returns its panel key."""
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return self.put_bytes(response.read())
+
+    def put_bytes(self, data):
+        """Stores image bytes (and their thumbnail) and returns the panel key."""
+        key = hashlib.sha256(data).hexdigest()
+        if not self.has(key):
+            write_atomic(self.path(key), data)
+            write_atomic(self.path(key, thumbnail=True), self._make_thumbnail(data))
+        return key
+
+    def has(self, key):
+        return isinstance(key, str) and os.path.exists(self.path(key))
+
+    def path(self, key, thumbnail=False):
+        """Location of a panel on disk, sharded by the first two hex digits."""
+        name = f"{key}.thumb.jpg" if thumbnail else key
+        return os.path.join(self.root, key[:2], name)
+
+    def full(self, key):
+        """Full-resolution image bytes for a panel."""
+        return self._load(key, thumbnail=False)
+
+    def thumbnail(self, key):
+        """Compressed JPEG thumbnail bytes for a panel."""
+        return self._load(key, thumbnail=True)
+
+    def _load(self, key, thumbnail):
+        cache_key = (key, thumbnail)
+        with self._lock:
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                return self._cache[cache_key]
+        with open(self.path(key, thumbnail), "rb") as f:
+            data = f.read()
+        with self._lock:
+            self._cache[cache_key] = data
+            while len(self._cache) > self.cache_items:
+                self._cache.popitem(last=False)
+        return data
+
+    def _make_thumbnail(self, data):
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=80, optimize=True)
+        return out.getvalue()
+
+
+# Shared by every session in this process
+panel_store = PanelStore()
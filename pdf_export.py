@@ -0,0 +1,182 @@
+"""PDF export of finished stories.
+
+Exports run in a small process pool so layout and image recompression never
+compete with Streamlit for the GIL. The story's comic pages (see comic_pages)
+are converted to JPEG with Pillow one at a time before fpdf embeds them, which
+keeps peak memory flat however long the story is. Finished PDFs are cached
+on disk under a hash of the story, so repeat downloads are instant; a failed
+export is remembered too, so reruns don't start it over and over.
+
+Text is set in DejaVu Sans (the font comic_pages draws captions with), or in
+PDF_FONT_PATH, embedded as Unicode so stories in any script keep their text.
+Without a TrueType font, fpdf's Latin-1 core font is the fallback.
+
+This module is imported by worker processes, so it must not import Streamlit
+or anything that talks to the model providers.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from fpdf import FPDF
+from PIL import Image
+
+from comic_pages import PANELS_PER_PAGE
+
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", ".pdf_cache")
+PDF_EXPORT_WORKERS = int(os.getenv("PDF_EXPORT_WORKERS", "2"))
+PDF_IMAGE_MAX_SIDE = int(os.getenv("PDF_IMAGE_MAX_SIDE", "1024"))
+PDF_PAGE_WIDTH_MM = 170 # a comic page of four panels
+PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "") # regular weight; a "-Bold" sibling is used if present
+_FONT_DIRS = ("/usr/share/fonts/truetype/dejavu", "/usr/share/fonts/dejavu", "/usr/share/fonts/TTF", "/Library/Fonts")
+
+_executor = None
+_in_flight = {} # story hash -> Future
+_failed = {} # story hash -> exception of its failed export
+_lock = threading.RLock() # re-entrant: a finished job may call _forget while held
+
+# fpdf's core fonts are latin-1 only; map the usual typographic characters first
+_LATIN1_REPLACEMENTS = {
+    "‘": "'", "’": "'", "“": '"', "”": '"',
+    "–": "-", "—": "-", "…": "...",
+}
+
+
+def story_hash(title, story_history, page_paths):
+    """Stable hash of everything that ends up in the PDF."""
+    payload = json.dumps([title, story_history, page_paths], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _latin1(text):
+    for char, replacement in _LATIN1_REPLACEMENTS.items():
+        text = text.replace(char, replacement)
+    return text.encode("latin-1", "replace").decode("latin-1")
+
+
+def _find_font():
+    if PDF_FONT_PATH:
+        return PDF_FONT_PATH
+    for font_dir in _FONT_DIRS:
+        path = os.path.join(font_dir, "DejaVuSans.ttf")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _set_up_fonts(pdf):
+    """Registers the Unicode font; returns (font family, text conversion)."""
+    path = _find_font()
+    if path is None:
+        return "Arial", _latin1
+    root, extension = os.path.splitext(path)
+    bold_path = f"{root}-Bold{extension}"
+    pdf.add_font("StoryFont", "", path, uni=True)
+    pdf.add_font("StoryFont", "B", bold_path if os.path.exists(bold_path) else path, uni=True)
+    return "StoryFont", str
+
+
+def _add_image(pdf, path):
+    """Downscales, recompresses and embeds one comic page; a missing page is skipped."""
+    if not path:
+        return
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        image.thumbnail((PDF_IMAGE_MAX_SIDE, PDF_IMAGE_MAX_SIDE))
+        fd, jpeg_path = tempfile.mkstemp(suffix=".jpg")
+        os.close(fd)
+        image.save(jpeg_path, format="JPEG", quality=80, optimize=True)
+    try:
+        # Without y, fpdf places the image at the cursor and breaks the page if needed
+        pdf.image(jpeg_path, x=(pdf.w - PDF_PAGE_WIDTH_MM) / 2, w=PDF_PAGE_WIDTH_MM)
+    finally:
+        os.remove(jpeg_path)
+    pdf.ln(6)
+
+
+def build_pdf(title, story_history, page_paths, out_path, panels_per_page=PANELS_PER_PAGE):
+    """Lays out the story page by page and writes it to `out_path`.
+
+    Each comic page follows the entries it illustrates: panels are drawn for
+    the story introduction and each AI continuation, so a page goes in after
+    every `panels_per_page` such entries, and the last one after the final
+    entry. `page_paths` holds the local image path of each comic page.
+    """
+    pdf = FPDF(orientation="P", unit="mm", format="A4")
+    pdf.set_auto_page_break(auto=True, margin=15)
+    font, text = _set_up_fonts(pdf)
+    pdf.add_page()
+    pdf.set_font(font, "B", 20)
+    pdf.multi_cell(0, 12, text(title), align="C")
+    pdf.ln(6)
+
+    pages = iter(page_paths)
+    panel_count = 0
+    for entry in story_history:
+        if entry["type"] == "plot":
+            heading = "Story Introduction"
+        elif entry["type"] == "user":
+            heading = f"{entry['character_name']} Says:"
+        else:
+            heading = "AI Continues:"
+        pdf.set_font(font, "B", 13)
+        pdf.multi_cell(0, 8, text(heading))
+        pdf.set_font(font, "", 11)
+        pdf.multi_cell(0, 6, text(entry["content"]))
+        pdf.ln(4)
+        if entry["type"] in ("plot", "ai"):
+            panel_count += 1
+            if panel_count % panels_per_page == 0:
+                _add_image(pdf, next(pages, None))
+    if panel_count % panels_per_page:
+        _add_image(pdf, next(pages, None))
+
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    pdf.output(tmp_path, "F")
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: forking a threaded Streamlit server is not safe
+        _executor = ProcessPoolExecutor(max_workers=PDF_EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def export_story_pdf(title, story_history, page_paths):
+    """Returns a Future for the path of the story's PDF.
+
+    Cached PDFs resolve immediately, as do stories whose export already
+    failed (with that error), and concurrent requests for the same story
+    share one export job.
+    """
+    key = story_hash(title, story_history, page_paths)
+    out_path = os.path.join(PDF_CACHE_DIR, f"{key}.pdf")
+    future = Future()
+    if os.path.exists(out_path):
+        future.set_result(out_path)
+        return future
+    with _lock:
+        if key in _failed:
+            future.set_exception(_failed[key])
+            return future
+        future = _in_flight.get(key)
+        if future is None:
+            os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+            future = _get_executor().submit(build_pdf, title, story_history, page_paths, out_path)
+            _in_flight[key] = future
+            future.add_done_callback(lambda job: _forget(key, job))
+    return future
+
+
+def _forget(key, job):
+    with _lock:
+        _in_flight.pop(key, None)
+        if not job.cancelled() and job.exception() is not None:
+            _failed[key] = job.exception()
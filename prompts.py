@@ -0,0 +1,123 @@
+"""Prompt templates for every chain the app runs, each compiled once on first use.
+
+Templates are ordered for prompt caching: static instructions come first, then
+theme text, then the character, and the story history last. All stories with
+the same theme share the instruction + theme prefix, and successive rounds of
+one story share everything up to the history, plus (between summary folds,
+see story_context) the history up to the latest turns. Providers (and local
+caches) can reuse that prefix instead of reprocessing it every round.
+
+LangChain's PromptTemplate and the tiktoken encoding are only loaded on first
+use (or by the warm-up), so importing this module stays cheap.
+"""
+import threading
+
+_prompts = {}
+_encoding = None
+_encoding_loaded = False
+_lock = threading.Lock()
+
+# Story themes players (and batch jobs) can pick, with the description the prompts use
+THEME_DESCRIPTIONS = {
+    "Final Destination": "Death has a plan — and your character is in its path. Each move by the user brings danger, but the AI must twist fate and keep them alive. Expect close calls, clever saves, and suspense at every step.",
+    "Survival": "Nature shows no mercy. Your character is being hunted — not by a person, but by the world itself. From collapsing caves to monster ambushes, the AI launches life-threatening events. The user must fight to keep the story (and character) alive.",
+    "Superhero Tale": "Behind every mask is a secret. Dive into the double life of a hero blessed (or cursed) with powers, fighting not just crime but personal battles. Supervillains rise. Cities fall. And one hero stands in the middle.",
+    "Fantasy Adventure": "Step into a world where dragons fly, spells crackle in the air, and ancient maps lead to hidden realms. Magic pulses through every tree and stone — and your character is about to set foot on a quest that will test their courage, wits, and heart.",
+    "Mystery": "Whispers in the dark. Clues in plain sight. Someone is hiding the truth — and your character is on the trail. In a world filled with riddles and red herrings, only sharp minds and sharper instincts will survive.",
+    "Slice of Life": "Sometimes, the quietest moments say the most. Follow your character through life’s small joys, awkward stumbles, and deep connections. From classrooms to coffee shops, this is a story about being human — honest, funny, and real.",
+    "Sci-Fi Journey": "Rocket through galaxies, hack into alien tech, and face decisions that shape the fate of civilizations. From abandoned space stations to worlds ruled by AIs, your character must navigate the future — one jump at a time."
+}
+
+INITIAL_PLOT_TEMPLATE = """You are a creative storyteller. Craft a clear and engaging opening for a comic story.
+Describe the setting in a simple and vivid way. Introduce the main character naturally, based on the theme and description. Use clear, simple English and short sentences that are easy to follow. End the scene with a hint of a problem, mystery, or challenge that connects to the description.
+Keep the story between 100 and 120 words. The tone should be visual and easy to imagine, like the first page of a comic story.
+Theme: {theme}
+Story description: {description}
+Main character: {character}
+Story Opening:"""
+
+CONTINUATION_TEMPLATE = """You are a creative storyteller continuing a comic-style story in clear and simple English. Your task is to respond directly to the main character’s latest action and push the story forward, using the theme to guide your tone and choices.
+Continue the story in 60-80 words. Respond naturally to the main character's latest move. Let the events reflect the theme — whether it’s saving the character, putting them in danger, uncovering mystery, or exploring emotions. Be visual, engaging, and leave the story open for the next step.
+Theme: {theme}
+Theme Description (use this to guide your style and what should happen): {description}
+Main Character: {character}
+Story So Far:
+{history_for_prompt}
+{character}'s Latest Action: {latest_user_input}
+Your Response:"""
+
+SUMMARY_TEMPLATE = """You keep notes on a comic-style story so it can be continued consistently.
+Rewrite the summary so it also covers the new events, in at most 120 words of clear and simple English. Keep character names, places, important objects and any unresolved dangers or mysteries. Leave out style and dialogue.
+Summary So Far: {summary}
+New Events: {new_events}
+Updated Summary:"""
+
+TEMPLATES = {
+    "initial_plot": INITIAL_PLOT_TEMPLATE,
+    "continuation": CONTINUATION_TEMPLATE,
+    "summary": SUMMARY_TEMPLATE,
+}
+
+# Variables that change from round to round; the prompt before the first of
+# them is the prefix successive rounds of one story share.
+_ROUND_VARIABLES = ("history_for_prompt", "latest_user_input", "summary", "new_events")
+
+
+def get_prompt(name):
+    """Returns the PromptTemplate for chain `name`, compiling it on first use."""
+    with _lock:
+        prompt = _prompts.get(name)
+        if prompt is None:
+            from langchain.prompts import PromptTemplate
+            prompt = _prompts[name] = PromptTemplate.from_template(TEMPLATES[name])
+    return prompt
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    with _lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception: # tiktoken is optional; fall back to a rough estimate
+                _encoding = None
+            _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Counts prompt tokens, or estimates them at ~4 characters each."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def render_prompt(name, **inputs):
+    """Returns the full prompt text chain `name` would send for `inputs`."""
+    # The templates are plain f-string templates, so this matches PromptTemplate.format
+    return TEMPLATES[name].format(**inputs)
+
+
+def prompt_stats(name, **inputs):
+    """Token counts for a prompt and its cacheable prefixes.
+
+    - total_tokens: the whole prompt.
+    - static_tokens: instructions before the first variable, shared by every request.
+    - story_prefix_tokens: the template up to the story history, shared by
+      every round of the same story. Between summary folds the history itself
+      is append-only too (see story_context, which records how much of it
+      each round reuses as story_history_reused_tokens).
+    """
+    template = TEMPLATES[name]
+    static_end = template.index("{")
+    story_end = min(
+        (template.index("{" + var + "}") for var in _ROUND_VARIABLES if "{" + var + "}" in template),
+        default=len(template),
+    )
+    return {
+        "total_tokens": count_tokens(render_prompt(name, **inputs)),
+        "static_tokens": count_tokens(template[:static_end]),
+        "story_prefix_tokens": count_tokens(template[:story_end].format(**inputs)),
+    }
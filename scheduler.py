@@ -0,0 +1,199 @@
+"""Process-wide admission control for calls to the model providers.
+
+Every OpenAI and Replicate call first asks for a Ticket. Tickets are granted
+in priority order (then first come, first served) when all three allow it:
+- the backend's token bucket, a requests-per-minute limit
+- the backend's concurrency limit
+- the global concurrency limit shared by all backends
+
+Excess demand waits in line instead of failing against the provider's rate
+limits, and callers can show a waiting ticket's queue position.
+"""
+import asyncio
+import itertools
+import os
+import threading
+import time
+
+from metrics import metrics
+
+# Lower numbers go first
+PRIORITY_TEXT = 0 # story text the player is waiting for
+PRIORITY_IMAGE = 1 # panels for the player's current story
+PRIORITY_BACKGROUND = 2 # work for active stories nobody is waiting on yet, e.g. summaries
+PRIORITY_PREGEN = 3 # warm pool pre-generation
+
+BACKEND_LIMITS = {
+    # backend: (requests per minute, max concurrent calls)
+    "openai": (float(os.getenv("OPENAI_RPM", "500")), int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))),
+    "replicate": (float(os.getenv("REPLICATE_RPM", "120")), int(os.getenv("REPLICATE_MAX_CONCURRENCY", "8"))),
+}
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "36"))
+
+
+class TokenBucket:
+    """Allows `rate_per_minute` requests a minute, with bursts up to `burst`."""
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst or max(1.0, self.rate * 5) # up to ~5 seconds of quota at once
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def seconds_until_token(self, now):
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Ticket:
+    """A place in line for one provider call; release it when the call ends."""
+
+    def __init__(self, scheduler, backend, priority, seq):
+        self.scheduler = scheduler
+        self.backend = backend
+        self.priority = priority
+        self.seq = seq
+        self.requested = time.monotonic()
+        self.granted = False
+        self.released = False
+        self._event = threading.Event()
+        self._callbacks = []
+
+    @property
+    def position(self):
+        """1-based place in line for this backend, or 0 once granted."""
+        return self.scheduler.position(self)
+
+    def on_grant(self, callback):
+        """Calls `callback()` once the ticket is granted (immediately if it already is)."""
+        with self.scheduler._cond:
+            if not self.granted:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self, timeout=None):
+        """Blocks until granted; returns False if `timeout` ran out first."""
+        return self._event.wait(timeout)
+
+    async def wait_async(self):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        self.on_grant(wake)
+        await granted
+
+    def release(self):
+        """Frees the slot, or leaves the line if not granted yet. Safe to call twice."""
+        self.scheduler._release(self)
+
+    def __del__(self):
+        # Safety net: a caller dropped its ticket (e.g. the script was
+        # interrupted before the call started) without releasing the slot
+        if not self.released:
+            self.release()
+
+    def _grant(self):
+        # Called by the dispatcher with the scheduler lock held
+        self.granted = True
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        return callbacks
+
+
+class Scheduler:
+    """Grants tickets per backend under rate, concurrency and priority rules."""
+
+    def __init__(self, backend_limits=BACKEND_LIMITS, max_concurrency=ADMISSION_MAX_CONCURRENCY):
+        self._buckets = {name: TokenBucket(rpm) for name, (rpm, _) in backend_limits.items()}
+        self._limits = {name: concurrency for name, (_, concurrency) in backend_limits.items()}
+        self._running = {name: 0 for name in backend_limits}
+        self.max_concurrency = max_concurrency
+        self._waiting = [] # kept sorted by (priority, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._dispatch_forever, name="admission", daemon=True).start()
+
+    def request(self, backend, priority=PRIORITY_TEXT):
+        """Joins the line for `backend` and returns the Ticket."""
+        with self._cond:
+            ticket = Ticket(self, backend, priority, next(self._seq))
+            self._waiting.append(ticket)
+            self._waiting.sort(key=lambda t: (t.priority, t.seq))
+            self._cond.notify()
+        return ticket
+
+    def position(self, ticket):
+        with self._cond:
+            if ticket.granted or ticket.released:
+                return 0
+            ahead = 0
+            for other in self._waiting:
+                if other is ticket:
+                    return ahead + 1
+                if other.backend == ticket.backend:
+                    ahead += 1
+        return 0
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self._running[ticket.backend] -= 1
+            else:
+                self._waiting.remove(ticket)
+            self._cond.notify()
+
+    def _dispatch_forever(self):
+        while True:
+            callbacks = []
+            with self._cond:
+                retry_in = self._grant_ready(callbacks)
+                if not callbacks:
+                    self._cond.wait(timeout=retry_in)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Admission callback failed: {e}")
+
+    def _grant_ready(self, callbacks):
+        """Grants every ticket that can run now; returns seconds until a bucket refills."""
+        now = time.monotonic()
+        retry_in = None
+        for ticket in list(self._waiting):
+            if sum(self._running.values()) >= self.max_concurrency:
+                break
+            backend = ticket.backend
+            if self._running[backend] >= self._limits[backend]:
+                continue
+            bucket = self._buckets[backend]
+            if not bucket.try_take(now):
+                wait = bucket.seconds_until_token(now)
+                retry_in = wait if retry_in is None else min(retry_in, wait)
+                continue
+            self._waiting.remove(ticket)
+            self._running[backend] += 1
+            callbacks.extend(ticket._grant())
+            metrics.observe("admission_wait_seconds", now - ticket.requested, backend=backend, priority=ticket.priority)
+        return retry_in
+
+
+# Shared by every session in this process
+admission = Scheduler()
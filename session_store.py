@@ -0,0 +1,165 @@
+"""Stories saved outside the Streamlit session, so they survive restarts.
+
+A story is keyed by a random story id, kept in the page URL (`?story=<id>`).
+The id is the only way to load a story back, so it works as its secret.
+Writes are incremental and append-only: one row per story entry and one per finished panel, never a
+rewrite of the whole history. A reconnecting session loads its story lazily,
+the first time the script runs without one in memory.
+
+The default backend is a SQLite file in WAL mode, so several Streamlit
+processes on one host (or on a shared volume) can serve the same stories.
+Other databases plug in by subclassing SessionStore and registering the class
+in SESSION_STORE_BACKENDS.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite") # "none" keeps stories in memory only
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", ".sessions.db")
+SESSION_DB_POOL_SIZE = int(os.getenv("SESSION_DB_POOL_SIZE", "4")) # idle connections kept open
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    story_id TEXT PRIMARY KEY,
+    email TEXT,
+    character TEXT NOT NULL,
+    theme TEXT NOT NULL,
+    description TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS story_entries (
+    story_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    character_name TEXT,
+    content TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (story_id, seq)
+);
+CREATE TABLE IF NOT EXISTS story_panels (
+    story_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    panel TEXT,
+    created REAL NOT NULL,
+    PRIMARY KEY (story_id, idx)
+);
+"""
+
+
+class SessionStore:
+    """Interface of a story store. This base class keeps nothing."""
+
+    def create(self, story_id, email, character, theme, description):
+        """Registers a new, empty story."""
+
+    def append_entry(self, story_id, seq, entry):
+        """Saves history entry number `seq`. Saving the same entry twice is a no-op."""
+
+    def set_panel(self, story_id, idx, panel):
+        """Saves the final value of panel `idx`: a panel key, error marker or None."""
+
+    def load(self, story_id):
+        """Returns the saved story, or None.
+
+        A story is a dict with email, character, theme, description, entries
+        (the story history, in order) and panels ({idx: final value}).
+        """
+        return None
+
+
+class SQLiteSessionStore(SessionStore):
+    """Stories in a SQLite database in WAL mode.
+
+    Streamlit runs every script run on a new thread, so connections aren't
+    tied to threads: each call borrows one from a small shared pool and hands
+    it back, and only connections beyond `pool_size` are closed.
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, pool_size=SESSION_DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle = [] # connections not in use
+        self._lock = threading.Lock()
+        with self._connection() as db:
+            db.execute("PRAGMA journal_mode=WAL") # stored in the database file, so set once
+            db.executescript(_SCHEMA)
+
+    def _open(self):
+        # Readers never block the writer in WAL mode; the timeout covers writer contention
+        db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.row_factory = sqlite3.Row
+        return db
+
+    @contextmanager
+    def _connection(self):
+        """A pooled connection for one transaction, committed if the block succeeds."""
+        with self._lock:
+            db = self._idle.pop() if self._idle else None
+        if db is None:
+            db = self._open()
+        try:
+            with db:
+                yield db
+        finally:
+            with self._lock:
+                keep = len(self._idle) < self.pool_size
+                if keep:
+                    self._idle.append(db)
+            if not keep:
+                db.close()
+
+    def create(self, story_id, email, character, theme, description):
+        with self._connection() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO stories VALUES (?, ?, ?, ?, ?, ?)",
+                (story_id, email or None, character, theme, description, time.time()),
+            )
+
+    def append_entry(self, story_id, seq, entry):
+        with self._connection() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO story_entries VALUES (?, ?, ?, ?, ?, ?)",
+                (story_id, seq, entry["type"], entry.get("character_name"), entry["content"], time.time()),
+            )
+
+    def set_panel(self, story_id, idx, panel):
+        with self._connection() as db:
+            db.execute("INSERT OR IGNORE INTO story_panels VALUES (?, ?, ?, ?)", (story_id, idx, panel, time.time()))
+
+    def load(self, story_id):
+        with self._connection() as db:
+            story = db.execute("SELECT * FROM stories WHERE story_id = ?", (story_id,)).fetchone()
+            if story is None:
+                return None
+            entry_rows = db.execute("SELECT * FROM story_entries WHERE story_id = ? ORDER BY seq", (story_id,)).fetchall()
+            panel_rows = db.execute("SELECT idx, panel FROM story_panels WHERE story_id = ?", (story_id,)).fetchall()
+        entries = []
+        for row in entry_rows:
+            if row["seq"] != len(entries):
+                break # A gap means a write was lost; keep the story up to it
+            entry = {"type": row["type"], "content": row["content"]}
+            if row["character_name"] is not None:
+                entry["character_name"] = row["character_name"]
+            entries.append(entry)
+        panels = {row["idx"]: row["panel"] for row in panel_rows}
+        return {
+            "email": story["email"] or "",
+            "character": story["character"],
+            "theme": story["theme"],
+            "description": story["description"],
+            "entries": entries,
+            "panels": panels,
+        }
+
+
+SESSION_STORE_BACKENDS = {
+    "sqlite": SQLiteSessionStore,
+    "none": SessionStore,
+}
+
+# Shared by every session in this process
+session_store = SESSION_STORE_BACKENDS[SESSION_STORE]()
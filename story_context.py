@@ -0,0 +1,101 @@
+"""Bounded story history for continuation prompts.
+
+Only the last few turns go into a prompt verbatim. Older turns are folded into
+a running summary, so prompt size stays bounded instead of growing every round.
+Turns are folded STORY_SUMMARY_BLOCK_TURNS at a time, not one per round: in
+between, the summary stays put and new turns are only appended after it, so
+successive prompts share everything up to the latest turns and the provider
+can reuse that prefix from its prompt cache.
+The summary is refreshed in the background after the AI reply that completes
+a block, and is usually ready before the player submits their next action.
+A round only waits for it (at most STORY_SUMMARY_WAIT_SECONDS) when the
+verbatim turns no longer fit the token budget; otherwise, and if the wait runs
+out, the prompt is built from the previous summary and the verbatim turns,
+and the new summary is applied on a later round. A summary call that fails
+partway is discarded, keeping the previous summary and the turns it missed.
+"""
+import asyncio
+import os
+from concurrent.futures import CancelledError, wait
+
+from metrics import metrics
+from prompts import count_tokens
+from streaming import get_loop
+from utils import asummarize_story, format_story_history
+
+STORY_RECENT_TURNS = int(os.getenv("STORY_RECENT_TURNS", "3"))
+STORY_CONTEXT_TOKEN_BUDGET = int(os.getenv("STORY_CONTEXT_TOKEN_BUDGET", "1500"))
+STORY_SUMMARY_WAIT_SECONDS = float(os.getenv("STORY_SUMMARY_WAIT_SECONDS", "2"))
+STORY_SUMMARY_BLOCK_TURNS = int(os.getenv("STORY_SUMMARY_BLOCK_TURNS", "3"))
+
+
+class StoryContext:
+    """Keeps recent turns verbatim and a summary of everything before them.
+
+    Kept per session in `st.session_state.story_context`. History is passed in
+    as the same list of entry contents the app builds for prompts:
+    [plot, user_1, ai_1, user_2, ai_2, ...]. Background summaries stop when
+    `cancel_token` is cancelled.
+    """
+
+    def __init__(self, recent_turns=STORY_RECENT_TURNS, token_budget=STORY_CONTEXT_TOKEN_BUDGET, cancel_token=None,
+                 summary_wait=STORY_SUMMARY_WAIT_SECONDS, block_turns=STORY_SUMMARY_BLOCK_TURNS):
+        self.recent_entries = recent_turns * 2 # a turn is a user action and the AI reply
+        self.block_entries = max(block_turns, 1) * 2
+        self.token_budget = token_budget
+        self.summary_wait = summary_wait
+        self.summary = ""
+        self.summarized_count = 0 # leading history entries already in the summary
+        self._pending = None # Future of (summary, summarized_count)
+        self.cancel_token = cancel_token
+        self._last_text = "" # history text of the previous prompt
+
+    def schedule_summary(self, history_list):
+        """Starts folding turns that left the verbatim window, once a whole block of them has."""
+        fold_until = len(history_list) - self.recent_entries
+        if fold_until - self.summarized_count < self.block_entries or self._pending is not None:
+            return
+        new_events = format_story_history(history_list[self.summarized_count:fold_until])
+        coro = self._fold(self.summary, new_events, fold_until)
+        self._pending = asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+    async def _fold(self, summary, new_events, fold_until):
+        return await asummarize_story(summary, new_events, self.cancel_token), fold_until
+
+    def _collect(self, timeout=0):
+        """Applies the background summary if it finishes within `timeout` seconds."""
+        if self._pending is None:
+            return
+        if not wait([self._pending], timeout=timeout).done:
+            return # Still running; a later round applies it
+        try:
+            summary, summarized_count = self._pending.result()
+            if summary:
+                self.summary, self.summarized_count = summary, summarized_count
+        except (Exception, CancelledError) as e:
+            print(f"Story summary failed, keeping full history: {e}")
+        self._pending = None
+
+    def _format(self, history_list):
+        recent = list(history_list[self.summarized_count:])
+        parts = [f"Earlier in the story: {self.summary}"] if self.summary else []
+        return parts, recent, format_story_history(parts + recent)
+
+    def build(self, history_list):
+        """Returns the "story so far" text for the next prompt, within the token budget."""
+        self._collect()
+        parts, recent, text = self._format(history_list)
+        # Only worth waiting on the summary when the turns would otherwise be cut
+        if self._pending is not None and count_tokens(text) > self.token_budget:
+            self._collect(self.summary_wait)
+            parts, recent, text = self._format(history_list)
+        # Drop the oldest verbatim entries until the context fits the budget
+        while recent and count_tokens(text) > self.token_budget:
+            recent.pop(0)
+            text = format_story_history(parts + recent)
+        # How much of this history the previous round's prompt already had, i.e. could come from the prompt cache
+        shared = os.path.commonprefix([self._last_text, text])
+        metrics.observe("story_history_reused_tokens", count_tokens(shared) if shared else 0)
+        self._last_text = text
+        return text
+
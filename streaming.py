@@ -0,0 +1,238 @@
+"""Event-driven token streaming for LLM chains.
+
+All generations run as asyncio tasks on one background event loop, so an
+in-flight stream costs a task instead of an OS thread. Tokens travel from the
+LangChain callback to the consumer through an asyncio.Queue, and the stream
+ends the moment the chain finishes instead of on a polling timeout.
+`iter_sync` and `run_sync` adapt the async API for Streamlit's script thread.
+openai, aiohttp and LangChain are imported on first use (or by the warm-up).
+"""
+import functools
+import asyncio
+import io
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Iterator
+
+from cancellation import CancelToken, Cancelled, record_cancelled
+from metrics import metrics
+from scheduler import PRIORITY_TEXT, admission
+from warmup import mark_first
+
+_END = object() # Queue sentinel marking the end of a stream
+
+# How often a stream may repaint its placeholder, and how much text may queue up
+STREAM_RENDER_INTERVAL_MS = int(os.getenv("STREAM_RENDER_INTERVAL_MS", "50"))
+STREAM_RENDER_MAX_CHARS = int(os.getenv("STREAM_RENDER_MAX_CHARS", "120"))
+_SENTENCE_ENDS = (".", "!", "?", "\n")
+
+_loop = None
+_loop_lock = threading.Lock()
+_http_session = None
+_llm_durations = deque(maxlen=100) # seconds taken by recent completed generations
+
+
+@functools.lru_cache(maxsize=None)
+def _token_handler_class():
+    """The LangChain callback class that feeds a token queue, defined on first use."""
+    from langchain.callbacks.base import AsyncCallbackHandler
+
+    class AsyncTokenQueueHandler(AsyncCallbackHandler):
+        """Pushes each streamed token onto an asyncio.Queue."""
+
+        def __init__(self, queue: asyncio.Queue):
+            super().__init__()
+            self._queue = queue
+
+        async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+            self._queue.put_nowait(token)
+
+    return AsyncTokenQueueHandler
+
+
+def get_loop():
+    """Returns the shared streaming event loop, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-stream-loop", daemon=True).start()
+    return _loop
+
+
+def _get_http_session():
+    """Returns the pooled aiohttp session openai uses for every request.
+
+    Must be called on the streaming loop, which owns the session.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=int(os.getenv("HTTP_POOL_SIZE", "32")))
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+
+async def astream_chain(chain, inputs: dict, labels=None, ticket=None, priority=PRIORITY_TEXT, cancel_token=None,
+                        raise_errors=False) -> AsyncIterator[str]:
+    """Runs `chain` on `inputs` and yields its tokens as they arrive.
+
+    The call waits for an OpenAI admission ticket first: `ticket` if the caller
+    already holds one, else a new one at `priority`. Errors end the stream
+    early, as the UI treats a short response the same as a finished one;
+    with `raise_errors`, the error is raised once the stream ends instead, for
+    callers that must not mistake a cut-off response for a whole one.
+    Closing the iterator cancels the underlying LLM call, and so does
+    cancelling `cancel_token`, which also raises Cancelled. Timings are
+    recorded in `metrics`, tagged with `labels`.
+    """
+    labels = labels or {}
+    cancel_token = cancel_token or CancelToken() # nobody else can cancel a fresh token
+    if ticket is None:
+        ticket = admission.request("openai", priority)
+    try:
+        try:
+            await cancel_token.race(ticket.wait_async())
+        except Cancelled:
+            record_cancelled(cancel_token, "openai", 0.0, _typical_llm_seconds(), **labels)
+            raise
+        import openai
+        # Task context is copied at creation, so the chain task inherits the session
+        openai.aiosession.set(_get_http_session())
+        queue = asyncio.Queue()
+        started = time.perf_counter()
+        first_token_at = None
+        token_count = 0
+        task = asyncio.create_task(chain.arun(inputs, callbacks=[_token_handler_class()(queue)]))
+        task.add_done_callback(lambda _: queue.put_nowait(_END))
+        loop = asyncio.get_running_loop()
+        # Cancelling the task closes its HTTP request
+        forget = cancel_token.add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+        try:
+            while True:
+                token = await queue.get()
+                if token is _END:
+                    break
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    metrics.observe("llm_time_to_first_token_seconds", first_token_at - started, **labels)
+                    mark_first("llm_token")
+                token_count += 1
+                yield token
+            if task.cancelled():
+                if cancel_token.cancelled:
+                    record_cancelled(cancel_token, "openai", time.perf_counter() - started, _typical_llm_seconds(), **labels)
+                    raise Cancelled(cancel_token.reason)
+            elif task.exception() is not None:
+                print(f"Error in LLM stream: {task.exception()}")
+                metrics.inc("llm_errors_total", **labels)
+                if raise_errors:
+                    raise task.exception()
+            else:
+                _llm_durations.append(time.perf_counter() - started)
+        finally:
+            forget()
+            if not task.done():
+                task.cancel()
+            finished = time.perf_counter()
+            metrics.observe("llm_seconds", finished - started, **labels)
+            if first_token_at is not None and finished > first_token_at:
+                metrics.observe("llm_tokens_per_second", token_count / (finished - first_token_at), **labels)
+    finally:
+        ticket.release()
+
+
+def _typical_llm_seconds():
+    """Mean duration of recent generations, the time a cancelled one would have taken."""
+    durations = list(_llm_durations)
+    return sum(durations) / len(durations) if durations else 0.0
+
+
+async def acollect(stream: AsyncIterator[str]) -> str:
+    """Drains a token stream into a single string."""
+    return "".join([token async for token in stream])
+
+
+async def _anext(stream: AsyncIterator[str]):
+    return await stream.__anext__()
+
+
+def iter_sync(stream: AsyncIterator[str]) -> Iterator[str]:
+    """Iterates an async token stream from synchronous code.
+
+    The caller's thread blocks on each token only until it arrives. If the
+    caller stops early (or Streamlit interrupts the script), the async stream
+    is closed and its LLM call cancelled. Cancelled is raised to the caller
+    if the stream's cancel token was cancelled.
+    """
+    loop = get_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(_anext(stream), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        asyncio.run_coroutine_threadsafe(stream.aclose(), loop)
+
+
+def run_sync(coro):
+    """Runs a coroutine on the streaming loop and waits for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+async def _open_http_session():
+    _get_http_session()
+
+
+def prewarm():
+    """Starts the streaming loop and opens its pooled HTTP session ahead of the first stream."""
+    run_sync(_open_http_session())
+
+
+class StreamRenderer:
+    """Coalesces streamed tokens into a few placeholder repaints ("frames").
+
+    A frame is drawn when the render interval has passed, when enough text has
+    queued up, or at the end of a sentence. The text is kept in a running
+    buffer, so a token costs an append instead of a rejoin of the response.
+    `placeholder` is anything with a `markdown(text)` method, e.g. `st.empty()`.
+    """
+
+    def __init__(self, placeholder, interval_ms=STREAM_RENDER_INTERVAL_MS, max_chars=STREAM_RENDER_MAX_CHARS):
+        self.placeholder = placeholder
+        self.interval = interval_ms / 1000
+        self.max_chars = max_chars
+        self.tokens = 0
+        self.frames = 0
+        self._buffer = io.StringIO()
+        self._unrendered_chars = 0
+        self._last_frame = 0.0
+
+    def feed(self, token):
+        self._buffer.write(token)
+        self.tokens += 1
+        self._unrendered_chars += len(token)
+        now = time.monotonic()
+        if (now - self._last_frame >= self.interval
+                or self._unrendered_chars >= self.max_chars
+                or token.rstrip(" \"'").endswith(_SENTENCE_ENDS)):
+            self._render(now)
+
+    def finish(self):
+        """Draws whatever is still pending and returns the full text."""
+        if self._unrendered_chars:
+            self._render(time.monotonic())
+        return self.text
+
+    @property
+    def text(self):
+        return self._buffer.getvalue()
+
+    def _render(self, now):
+        self.placeholder.markdown(self.text)
+        self.frames += 1
+        self._unrendered_chars = 0
+        self._last_frame = now
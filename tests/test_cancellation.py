@@ -0,0 +1,85 @@
+import asyncio
+from concurrent.futures import CancelledError
+
+import pytest
+
+from cancellation import CancelScope, CancelToken, Cancelled
+from scheduler import Scheduler
+
+
+def test_cancel_runs_callbacks_once_and_reaches_children():
+    parent = CancelToken()
+    child = CancelToken(parent)
+    calls = []
+    child.add_callback(lambda: calls.append(child.reason))
+    parent.cancel("reset")
+    parent.cancel("again")
+    assert child.cancelled and calls == ["reset"]
+    with pytest.raises(Cancelled):
+        child.check()
+
+
+def test_unregistered_callback_is_not_called():
+    token = CancelToken()
+    calls = []
+    forget = token.add_callback(lambda: calls.append(1))
+    forget()
+    token.cancel()
+    assert calls == []
+
+
+def test_new_request_supersedes_the_previous_one_for_its_stage():
+    scope = CancelScope()
+    first = scope.token("story_text")
+    other_stage = scope.token("summary")
+    second = scope.token("story_text")
+    assert first.cancelled and first.reason == "superseded"
+    assert not second.cancelled and not other_stage.cancelled
+    scope.cancel()
+    assert second.reason == "reset" and other_stage.reason == "reset"
+
+
+def test_race_raises_cancelled():
+    token = CancelToken()
+
+    async def scenario():
+        waiting = asyncio.ensure_future(token.race(asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        token.cancel("reset")
+        await waiting
+
+    with pytest.raises(Cancelled):
+        asyncio.run(scenario())
+
+
+@pytest.fixture
+def utils_with_stuck_line(monkeypatch, tmp_path):
+    """utils with a Replicate line that never grants, so panels stay queued."""
+    monkeypatch.setenv("PANEL_STORE_DIR", str(tmp_path))
+    utils = pytest.importorskip("utils") # needs the app's requirements installed
+    scheduler = Scheduler({"openai": (60000, 1), "replicate": (60000, 0)}, max_concurrency=1)
+    monkeypatch.setattr(utils, "admission", scheduler)
+    return utils, scheduler
+
+
+def test_cancelling_the_token_cancels_a_queued_panel(utils_with_stuck_line):
+    utils, scheduler = utils_with_stuck_line
+    scope = CancelScope()
+    panel = utils.submit_comic_image("The hero opens a glowing door.", cancel_token=scope.root)
+    assert panel.ticket.position == 1
+    scope.cancel("reset")
+    assert panel.cancelled()
+    assert panel.ticket.released and panel.ticket.position == 0
+    with pytest.raises(CancelledError):
+        panel.result(timeout=0)
+
+
+def test_superseded_token_cancels_only_its_own_panel(utils_with_stuck_line):
+    utils, scheduler = utils_with_stuck_line
+    scope = CancelScope()
+    old = utils.submit_comic_image("A storm breaks over the city.", cancel_token=scope.token("panel"))
+    new = utils.submit_comic_image("The storm clears over the city.", cancel_token=scope.token("panel"))
+    assert old.cancelled() and old.ticket.released
+    assert not new.done() and new.ticket.position == 1
+    scope.cancel()
+    assert new.cancelled()
@@ -0,0 +1,96 @@
+import pytest
+
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_IMAGE, PRIORITY_TEXT, Scheduler
+
+GRANT_TIMEOUT = 2.0 # generous; grants normally take milliseconds
+NOT_GRANTED = 0.2
+
+
+def make_scheduler(openai=1, replicate=1, total=10):
+    # High request rates, so only the concurrency limits hold tickets back
+    return Scheduler({"openai": (60000, openai), "replicate": (60000, replicate)}, max_concurrency=total)
+
+
+def test_grants_in_priority_order():
+    scheduler = make_scheduler(openai=1)
+    running = scheduler.request("openai", PRIORITY_TEXT)
+    assert running.wait(GRANT_TIMEOUT)
+    background = scheduler.request("openai", PRIORITY_BACKGROUND)
+    image = scheduler.request("openai", PRIORITY_IMAGE)
+    text = scheduler.request("openai", PRIORITY_TEXT)
+    assert [text.position, image.position, background.position] == [1, 2, 3]
+
+    # Each release lets exactly the next ticket in priority order through
+    for finished, expected, still_waiting in ((running, text, (image, background)), (text, image, (background,)), (image, background, ())):
+        finished.release()
+        assert expected.wait(GRANT_TIMEOUT)
+        assert not any(ticket.granted for ticket in still_waiting)
+    background.release()
+
+
+def test_backend_concurrency_cap():
+    scheduler = make_scheduler(openai=2)
+    first, second, third = (scheduler.request("openai") for _ in range(3))
+    assert first.wait(GRANT_TIMEOUT) and second.wait(GRANT_TIMEOUT)
+    assert not third.wait(NOT_GRANTED)
+    first.release()
+    assert third.wait(GRANT_TIMEOUT)
+    second.release()
+    third.release()
+
+
+def test_global_concurrency_cap_spans_backends():
+    scheduler = make_scheduler(openai=2, replicate=2, total=2)
+    text = scheduler.request("openai")
+    image = scheduler.request("replicate")
+    assert text.wait(GRANT_TIMEOUT) and image.wait(GRANT_TIMEOUT)
+    blocked = scheduler.request("openai")
+    assert not blocked.wait(NOT_GRANTED)
+    image.release()
+    assert blocked.wait(GRANT_TIMEOUT)
+    text.release()
+    blocked.release()
+
+
+def test_release_while_waiting_leaves_the_line():
+    scheduler = make_scheduler(openai=1)
+    running = scheduler.request("openai")
+    assert running.wait(GRANT_TIMEOUT)
+    gone = scheduler.request("openai")
+    after = scheduler.request("openai")
+    assert after.position == 2
+    gone.release()
+    gone.release() # twice is harmless
+    assert gone.position == 0 and after.position == 1
+    running.release()
+    assert after.wait(GRANT_TIMEOUT)
+    assert not gone.granted
+    after.release()
+
+
+def test_on_grant_runs_once_granted():
+    scheduler = make_scheduler(openai=1)
+    running = scheduler.request("openai")
+    assert running.wait(GRANT_TIMEOUT)
+    calls = []
+    queued = scheduler.request("openai")
+    queued.on_grant(lambda: calls.append("queued"))
+    assert not queued.wait(NOT_GRANTED) and calls == []
+    running.release()
+    assert queued.wait(GRANT_TIMEOUT)
+    running.on_grant(lambda: calls.append("already granted"))
+    assert "queued" in calls and "already granted" in calls
+    queued.release()
+
+
+@pytest.mark.parametrize("backend", ["openai", "replicate"])
+def test_position_is_per_backend(backend):
+    scheduler = make_scheduler(openai=1, replicate=1)
+    held = [scheduler.request(name) for name in ("openai", "replicate")]
+    assert all(ticket.wait(GRANT_TIMEOUT) for ticket in held)
+    other = "replicate" if backend == "openai" else "openai"
+    scheduler.request(other) # in line for the other backend only
+    ticket = scheduler.request(backend)
+    assert ticket.position == 1
+    for t in held + [ticket]:
+        t.release()
@@ -1,149 +1,72 @@
 import os
-import replicate
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.callbacks.base import BaseCallbackHandler
 from dotenv import load_dotenv
-import threading
-from queue import Queue, Empty
-from typing import Any
-
-# Custom Callback Handler to capture streamed tokens
-class TokenStreamCallbackHandler(BaseCallbackHandler):
-    def __init__(self, queue: Queue):
-        super().__init__()
-        self._queue = queue
-
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        self._queue.put(token)
-
-    def on_llm_end(self, response: Any, **kwargs: Any) -> None:
-        self._queue.put(None)  # Signal end of stream
-
-    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
-        self._queue.put(None)  # Signal end of stream on error
-
-# Wrapper to run LLMChain in a thread and yield tokens from the callback queue
-def _create_chain_stream_generator(chain: LLMChain, inputs: dict, token_queue: Queue):
-    def llm_thread_target():
-        try:
-            chain.run(inputs)
-        except Exception:
-            token_queue.put(None) # Ensure queue gets None on error in thread
-            # Optionally re-raise or log error from thread
-            # print(f"Error in LLM thread: {e}") 
-
-    thread = threading.Thread(target=llm_thread_target)
-    thread.start()
-
-    while True:
-        try:
-            token = token_queue.get(timeout=0.1) # Small timeout to prevent blocking UI
-            if token is None: # End of stream signal
-                break
-            yield token
-        except Empty:
-            # If queue is empty, check if thread is still alive
-            if not thread.is_alive() and token_queue.empty():
-                break # Thread finished and queue is empty
-            continue # Continue polling if thread is alive or queue might still get items
-    thread.join() # Ensure thread is cleaned up
-
 
+# Load .env before our own modules read their settings at import time
 load_dotenv()
 
-def generate_initial_plot_blocking(character, theme, description):
-    """Generates the initial story plot as a complete string (blocking)."""
-    token_queue = Queue()
-    llm = ChatOpenAI(
-        temperature=0.7,
-        streaming=True, # Still True for callback to work
-        callbacks=[TokenStreamCallbackHandler(token_queue)]
-    )
-    
-    template = """You are a creative storyteller. Craft a clear and engaging opening for a comic story.
-    Main character: {character}  
-    Theme: {theme}  
-    Story description: {description}
-    Describe the setting in a simple and vivid way. Introduce {character} naturally, based on the theme and description. Use clear, simple English and short sentences that are easy to follow. End the scene with a hint of a problem, mystery, or challenge that connects to the description.
-    Keep the story between 100 and 120 words. The tone should be visual and easy to imagine, like the first page of a comic story.
-    Story Opening:"""
-        
-    prompt = PromptTemplate(
-        input_variables=["character", "theme", "description"],
-        template=template
-    )
-    story_chain = LLMChain(llm=llm, prompt=prompt)
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from cancellation import Cancelled, record_cancelled
+from image_client import ImageTimeout, image_client
+from image_prompts import build_image_prompt
+from metrics import metrics
+from panel_cache import panel_cache
+from panel_store import panel_store
+from prompts import get_prompt, prompt_stats
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_IMAGE, PRIORITY_TEXT, admission
+from streaming import acollect, astream_chain, iter_sync, run_sync
+from warmup import mark_first
+
+_llm = None
+_chain_registry = {}
+_registry_lock = threading.Lock()
+
+def _get_llm():
+    """Returns the process-wide streaming ChatOpenAI client."""
+    global _llm
+    if _llm is None:
+        # Imported here so loading this module doesn't pull in LangChain (see warmup)
+        from langchain.chat_models import ChatOpenAI
+        # No callbacks here: each request attaches its own at call time
+        _llm = ChatOpenAI(temperature=0.7, streaming=True)
+    return _llm
+
+def set_llm(llm):
+    """Replaces the shared chat model, e.g. with a local stand-in for benchmarks."""
+    global _llm
+    with _registry_lock:
+        _llm = llm
+        _chain_registry.clear() # chains hold the old model
+    return llm
+
+def get_chain(name):
+    """Returns the shared LLMChain registered as `name`, building it on first use."""
+    with _registry_lock:
+        chain = _chain_registry.get(name)
+        if chain is None:
+            from langchain.chains import LLMChain
+            chain = LLMChain(llm=_get_llm(), prompt=get_prompt(name))
+            _chain_registry[name] = chain
+    return chain
+
+def _astream_prompt(name, inputs, labels, ticket=None, priority=PRIORITY_TEXT, cancel_token=None, raise_errors=False):
+    """Streams chain `name`, recording its prompt size and cacheable prefixes under `labels`."""
+    labels = {"stage": name, **(labels or {})}
+    stats = prompt_stats(name, **inputs)
+    metrics.observe("prompt_tokens", stats["total_tokens"], **labels)
+    metrics.observe("prompt_static_tokens", stats["static_tokens"], **labels)
+    metrics.observe("prompt_story_prefix_tokens", stats["story_prefix_tokens"], **labels)
+    return astream_chain(get_chain(name), inputs, labels, ticket=ticket, priority=priority, cancel_token=cancel_token,
+                         raise_errors=raise_errors)
+
+def astream_initial_plot(character, theme, description, labels=None, ticket=None, priority=PRIORITY_TEXT, cancel_token=None, raise_errors=False):
+    """Async iterator over the tokens of the initial story plot."""
     inputs = {"character": character, "theme": theme, "description": description}
+    return _astream_prompt("initial_plot", inputs, labels, ticket, priority, cancel_token, raise_errors)
 
-    # Run in a thread so UI doesn't freeze, but collect all tokens here
-    thread = threading.Thread(target=lambda: story_chain.run(inputs))
-    thread.start()
-
-    full_response_chunks = []
-    while True:
-        try:
-            token = token_queue.get(timeout=1) # Adjust timeout as needed
-            if token is None: # End of stream signal
-                break
-            full_response_chunks.append(token)
-        except Empty:
-            if not thread.is_alive() and token_queue.empty():
-                break
-            continue
-    thread.join()
-    return "".join(full_response_chunks)
-
-def generate_initial_plot_stream(character, theme, description):
-    """Generates the initial story plot as a stream of tokens using callbacks."""
-    token_queue = Queue()
-    llm = ChatOpenAI(
-        temperature=0.7,
-        streaming=True,
-        callbacks=[TokenStreamCallbackHandler(token_queue)]
-    )
-    
-    template = """You are a creative storyteller. Craft a clear and engaging opening for a comic story.
-    Main character: {character}  
-    Theme: {theme}  
-    Story description: {description}
-    Describe the setting in a simple and vivid way. Introduce {character} naturally, based on the theme and description. Use clear, simple English and short sentences that are easy to follow. End the scene with a hint of a problem, mystery, or challenge that connects to the description.
-    Keep the story between 100 and 120 words. The tone should be visual and easy to imagine, like the first page of a comic story.
-    Story Opening:"""
-    
-    prompt = PromptTemplate(
-        input_variables=["character", "theme"],
-        template=template
-    )
-    story_chain = LLMChain(llm=llm, prompt=prompt)
-    inputs = {"character": character, "theme": theme}
-    
-    return _create_chain_stream_generator(story_chain, inputs, token_queue)
-
-def generate_continuation_stream(history_for_prompt, latest_user_input, character, theme, description):
-    """Generates story continuation as a stream of tokens using callbacks."""
-    token_queue = Queue()
-    llm = ChatOpenAI(
-        temperature=0.7,
-        streaming=True,
-        callbacks=[TokenStreamCallbackHandler(token_queue)]
-    )
-    
-    template = """You are a creative storyteller continuing a comic-style story in clear and simple English. Your task is to respond directly to the main character’s latest action and push the story forward, using the theme to guide your tone and choices.
-    Main Character: {character}  
-    Theme: {theme}  
-    Theme Description (use this to guide your style and what should happen): {description}
-    Story So Far: {history_for_prompt}
-    {character}'s Latest Action: {latest_user_input}
-    Your Response: Continue the story in 60-80 words. Respond naturally to {character}'s latest move. Let the events reflect the theme — whether it’s saving the character, putting them in danger, uncovering mystery, or exploring emotions. Be visual, engaging, and leave the story open for the next step.
-    """
-    
-    prompt = PromptTemplate(
-        input_variables=["character", "theme", "description", "history_for_prompt", "latest_user_input"],
-        template=template
-    )
-    story_chain = LLMChain(llm=llm, prompt=prompt)
+def astream_continuation(history_for_prompt, latest_user_input, character, theme, description, labels=None, ticket=None, priority=PRIORITY_TEXT, cancel_token=None):
+    """Async iterator over the tokens of the next story continuation."""
     inputs = {
         "character": character,
         "theme": theme,
@@ -151,37 +74,132 @@ def generate_continuation_stream(history_for_prompt, latest_user_input, characte
         "history_for_prompt": history_for_prompt,
         "latest_user_input": latest_user_input
     }
-    
-    return _create_chain_stream_generator(story_chain, inputs, token_queue)
+    return _astream_prompt("continuation", inputs, labels, ticket, priority, cancel_token)
 
-from replicate.exceptions import ModelError
+async def asummarize_story(summary, new_events, cancel_token=None):
+    """Folds `new_events` into the running story summary; raises if the call fails partway."""
+    inputs = {"summary": summary or "(nothing yet)", "new_events": new_events}
+    stream = _astream_prompt("summary", inputs, None, priority=PRIORITY_BACKGROUND, cancel_token=cancel_token, raise_errors=True)
+    return (await acollect(stream)).strip()
 
-def generate_comic_image(prompt):
-    model = "iwasrobbed/sdxl-suspense:2717cb6a3d2505d13e1e05ba16cbfe188f86609b9060b785220d3c30cefe6242"
-    
-    # The new model might have different input parameters.
-    # Based on your example, it primarily uses "prompt".
-    # You might need to adjust this further based on the model's specific schema on Replicate.
+def generate_initial_plot_blocking(character, theme, description, labels=None, ticket=None, cancel_token=None):
+    """Generates the initial story plot as a complete string (blocking)."""
+    return run_sync(acollect(astream_initial_plot(character, theme, description, labels, ticket, cancel_token=cancel_token)))
+
+def generate_initial_plot_stream(character, theme, description, labels=None, ticket=None, cancel_token=None):
+    """Generates the initial story plot as a stream of tokens."""
+    return iter_sync(astream_initial_plot(character, theme, description, labels, ticket, cancel_token=cancel_token))
+
+def generate_continuation_stream(history_for_prompt, latest_user_input, character, theme, description, labels=None, ticket=None, cancel_token=None):
+    """Generates story continuation as a stream of tokens.
+
+    Pass a granted OpenAI `ticket` (see scheduler) to skip the admission wait,
+    e.g. after showing the player their place in line. Cancelling
+    `cancel_token` (see cancellation) aborts the call and raises Cancelled.
+    """
+    stream = astream_continuation(history_for_prompt, latest_user_input, character, theme, description, labels, ticket, cancel_token=cancel_token)
+    return iter_sync(stream)
+
+def generate_comic_image(prompt, cancel_token=None, labels=None):
+    # The model primarily uses "prompt"; deadlines, retries, hedging and the
+    # NSFW retry are handled by image_client.
     input_params = {
         "prompt": f"A comic panel in the style of TOK, depicting: {prompt}"
     }
     
     # print(f"DEBUG: Prompt for Replicate: {input_params['prompt']}") # For server-side debugging
+    from replicate.exceptions import ModelError
     try:
-        output = replicate.run(
-            model,
-            input=input_params
-        )
+        output = image_client.run(input_params, cancel_token, labels)
         return output[0] if output else None
     except ModelError as e:
         print(f"Replicate ModelError in generate_comic_image: {e}") 
         if "NSFW content detected" in str(e):
             return "error_nsfw" 
         return "error_model" # Generic model error
+    except Cancelled:
+        raise # Nobody needs the panel any more; not an error to show
+    except ImageTimeout as e:
+        print(f"Replicate timeout in generate_comic_image: {e}")
+        return "error_timeout"
     except Exception as e:
         print(f"Unexpected error in generate_comic_image: {e}")
         return "error_unknown"
 
+# Shared pool for comic panel jobs. Sessions hand their panels to it so the
+# slow image model never blocks the next round of the story.
+PANEL_WORKERS = int(os.getenv("PANEL_WORKERS", "8"))
+_panel_executor = ThreadPoolExecutor(max_workers=PANEL_WORKERS, thread_name_prefix="panel")
+
+def _generate_panel(prompt, submitted, labels, cancel_token=None):
+    """Generates a panel and keeps a local copy of it in the panel store."""
+    metrics.observe("replicate_queue_seconds", time.perf_counter() - submitted, **labels)
+    with metrics.timer("replicate_run_seconds", **labels):
+        image_url = generate_comic_image(prompt, cancel_token, labels)
+    mark_first("panel")
+    if not image_url or image_url.startswith("error_"):
+        metrics.inc("panel_errors_total", reason=image_url or "empty", **labels)
+        return image_url
+    try:
+        with metrics.timer("panel_store_seconds", **labels):
+            panel_key = panel_store.put_url(image_url)
+        panel_cache.put(prompt, image_client.model, panel_key)
+        return panel_key
+    except Exception as e:
+        print(f"Could not store panel {image_url}: {e}")
+        return image_url # Fall back to the remote URL
+
+def submit_comic_image(prompt, labels=None, priority=PRIORITY_IMAGE, cancel_token=None, character=None, theme=None):
+    """Queues a comic panel job in the background and returns its Future.
+
+    `prompt` is the story passage to illustrate. It is distilled into a short
+    visual prompt featuring `character` in the style of `theme` (see
+    image_prompts). If that prompt was drawn before, the Future comes back
+    already resolved from `panel_cache`, with `future.ticket` set to None.
+
+    The Future resolves to the panel's key in `panel_store`, one of the
+    "error_*" markers, None when the model returned no image, or the remote
+    URL if the panel could not be stored locally. Timings are recorded in
+    `metrics`, tagged with `labels`.
+
+    The job only reaches the executor once its Replicate admission ticket is
+    granted, so worker threads never sit waiting in line. The ticket is kept
+    on the Future as `future.ticket` so the UI can show its queue position.
+
+    Cancelling `cancel_token` cancels a queued Future outright, or stops a
+    running job, whose Future then raises Cancelled.
+    """
+    labels = labels or {}
+    image_prompt = build_image_prompt(prompt, character, theme)
+    future = Future()
+    cached = panel_cache.get(image_prompt, image_client.model)
+    if cached is not None:
+        future.ticket = None
+        future.set_result(cached)
+        return future
+    future.ticket = ticket = admission.request("replicate", priority)
+    submitted = time.perf_counter()
+
+    def run():
+        try:
+            if future.set_running_or_notify_cancel():
+                future.set_result(_generate_panel(image_prompt, submitted, labels, cancel_token))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            ticket.release()
+
+    if cancel_token is not None:
+        def cancel_queued():
+            if future.cancel(): # False once running; the job then stops itself
+                ticket.release()
+                record_cancelled(cancel_token, "replicate", 0.0, image_client.typical_seconds(), **labels)
+
+        forget = cancel_token.add_callback(cancel_queued)
+        future.add_done_callback(lambda _: forget())
+    ticket.on_grant(lambda: _panel_executor.submit(run))
+    return future
+
 def format_story_history(history_list):
     """Formats the story history list into a single string for AI context."""
     # history_list contains [initial_plot, user_1_input, ai_1_response, user_2_input, ai_2_response, ...]
@@ -0,0 +1,100 @@
+"""Pre-generated story openings, so "Create Story" rarely waits on the models.
+
+For every theme the pool keeps up to WARM_POOL_SIZE ready openings. Openings
+are written for a placeholder character whose name is filled in when the
+opening is served. Only the text is pooled: the first panel depends on the
+character's look, so the app submits it in the background like every other
+panel once the opening is served.
+Whenever a theme drops below WARM_POOL_LOW_WATER the pool refills it in the
+background. Generations that fail, or are cut off by an error, are discarded
+and retried with exponential backoff, up to WARM_POOL_RETRY_MAX_SECONDS apart.
+"""
+import asyncio
+import os
+import threading
+from collections import deque
+
+from scheduler import PRIORITY_PREGEN
+from streaming import acollect, get_loop
+from utils import astream_initial_plot
+
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "2")) # 0 disables the pool
+WARM_POOL_LOW_WATER = int(os.getenv("WARM_POOL_LOW_WATER", "1"))
+WARM_POOL_RETRY_SECONDS = float(os.getenv("WARM_POOL_RETRY_SECONDS", "5"))
+WARM_POOL_RETRY_MAX_SECONDS = float(os.getenv("WARM_POOL_RETRY_MAX_SECONDS", "300"))
+
+# Name the model writes instead of the player's character
+CHARACTER_PLACEHOLDER = "[HERO]"
+
+
+class WarmPool:
+    """Ready-to-serve story openings per theme."""
+
+    def __init__(self, theme_descriptions, size=WARM_POOL_SIZE, low_water=WARM_POOL_LOW_WATER):
+        self.theme_descriptions = theme_descriptions
+        self.size = size
+        self.low_water = low_water
+        self._ready = {theme: deque() for theme in theme_descriptions}
+        self._in_flight = {theme: 0 for theme in theme_descriptions}
+        self._failures = {theme: 0 for theme in theme_descriptions} # in a row
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Fills every theme up to the pool size in the background."""
+        for theme in self.theme_descriptions:
+            self._refill(theme, force=True)
+        return self
+
+    def take(self, theme, character):
+        """Returns an initial plot for `character`, or None if the theme is empty."""
+        with self._lock:
+            plot_template = self._ready[theme].popleft() if self._ready.get(theme) else None
+        self._refill(theme)
+        if plot_template is None:
+            return None
+        return plot_template.replace(CHARACTER_PLACEHOLDER, character)
+
+    def ready_count(self, theme):
+        with self._lock:
+            return len(self._ready[theme])
+
+    def _refill(self, theme, force=False):
+        with self._lock:
+            stocked = len(self._ready[theme]) + self._in_flight[theme]
+            if not force and len(self._ready[theme]) >= self.low_water:
+                return
+            missing = max(self.size - stocked, 0)
+            self._in_flight[theme] += missing
+        for _ in range(missing):
+            job = asyncio.run_coroutine_threadsafe(self._generate(theme), get_loop())
+            job.add_done_callback(lambda job, theme=theme: self._stock(theme, job))
+
+    async def _generate(self, theme):
+        description = self.theme_descriptions[theme]
+        labels = {"theme": theme, "round": 0, "source": "warm_pool"}
+        # A cut-off opening must not be served, so errors raise instead of ending the stream
+        stream = astream_initial_plot(CHARACTER_PLACEHOLDER, theme, description, labels, priority=PRIORITY_PREGEN, raise_errors=True)
+        plot = await acollect(stream)
+        # An opening that never names the placeholder would introduce someone else as the hero
+        if CHARACTER_PLACEHOLDER not in plot:
+            raise ValueError("opening never names the character placeholder")
+        return plot
+
+    def _stock(self, theme, job):
+        try:
+            opening = job.result()
+        except Exception as e:
+            print(f"Warm pool generation failed for {theme}: {e}")
+            opening = None
+        with self._lock:
+            self._in_flight[theme] -= 1
+            if opening is not None:
+                self._ready[theme].append(opening)
+                self._failures[theme] = 0
+                return
+            self._failures[theme] += 1
+            delay = min(WARM_POOL_RETRY_SECONDS * 2 ** (self._failures[theme] - 1), WARM_POOL_RETRY_MAX_SECONDS)
+        # Try again later rather than leave the theme empty until the next take()
+        retry = threading.Timer(delay, self._refill, (theme,))
+        retry.daemon = True
+        retry.start()
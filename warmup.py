@@ -0,0 +1,117 @@
+"""Cold-start warm-up and timing report.
+
+The provider SDKs (LangChain, openai, replicate) are imported on first use, so
+a fresh Streamlit worker draws its first page without waiting for them. The
+first script run calls `start_warmup()`, which does the slow parts in a
+background thread while the setup form is on screen:
+- imports the provider modules
+- compiles the prompt templates and loads the tiktoken encoding
+- builds the chat model client and the chains
+- starts the streaming loop and opens its pooled HTTP session
+- looks up the Replicate model version, opening that connection
+
+Each import and warm-up step, and the first page, LLM token and panel of the
+process, is timed from process start. The times go to metrics as
+`cold_start_seconds` and are printed as a JSON line, so cold-start
+regressions after scale-ups show up in the logs.
+
+    python warmup.py    # times the app's imports and the warm-up in a fresh process
+"""
+import importlib
+import json
+import threading
+import time
+
+from metrics import metrics
+
+# Roughly when the process started: this module is among the first the app imports
+_PROCESS_STARTED = time.perf_counter()
+
+APP_MODULES = ("utils", "warm_pool", "story_context", "pdf_export")
+PROVIDER_MODULES = (
+    "openai",
+    "aiohttp",
+    "langchain.chat_models",
+    "langchain.chains",
+    "langchain.callbacks.base",
+    "langchain.prompts",
+    "replicate",
+    "requests",
+)
+
+_report = {"imports": {}, "warmup": {}, "first": {}}
+_lock = threading.Lock()
+_started = False
+
+
+def _record(phase, step, seconds):
+    with _lock:
+        _report[phase][step] = round(seconds, 3)
+    metrics.observe("cold_start_seconds", seconds, phase=phase, step=step)
+
+
+def _timed(phase, step, func):
+    started = time.perf_counter()
+    try:
+        func()
+    except Exception as e:
+        print(f"Warm-up step {step} failed: {e}")
+        return
+    _record(phase, step, time.perf_counter() - started)
+
+
+def cold_start_report():
+    """Import, warm-up and first-request times recorded so far, in seconds."""
+    with _lock:
+        return {phase: dict(steps) for phase, steps in _report.items()}
+
+
+def _print_report():
+    print("Cold start: " + json.dumps(cold_start_report()))
+
+
+def warm_up(modules=PROVIDER_MODULES):
+    """Imports `modules` and pre-builds the provider clients (blocking)."""
+    for name in modules:
+        _timed("imports", name, lambda name=name: importlib.import_module(name))
+
+    from image_client import image_client
+    from prompts import TEMPLATES, count_tokens, get_prompt
+    from streaming import prewarm
+    from utils import get_chain
+
+    _timed("warmup", "prompts", lambda: [get_prompt(name) for name in TEMPLATES])
+    _timed("warmup", "tokenizer", lambda: count_tokens("warm up"))
+    _timed("warmup", "chains", lambda: [get_chain(name) for name in TEMPLATES])
+    _timed("warmup", "http_session", prewarm)
+    _timed("warmup", "replicate_version", image_client.prewarm)
+    _record("warmup", "done", time.perf_counter() - _PROCESS_STARTED)
+    _print_report()
+
+
+def start_warmup():
+    """Runs `warm_up` in a background thread, once per process."""
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+
+def mark_first(event):
+    """Records how long after process start `event` first happened, e.g. the first page."""
+    if event in _report["first"]: # cheap check; the hot paths call this often
+        return
+    with _lock:
+        if event in _report["first"]:
+            return
+        _report["first"][event] = None # claimed; filled in by _record below
+    _record("first", event, time.perf_counter() - _PROCESS_STARTED)
+    _print_report()
+
+
+if __name__ == "__main__":
+    # In a fresh process the app's own modules are timed first, so an eager
+    # provider import creeping back into them shows up as a jump here
+    warm_up(APP_MODULES + PROVIDER_MODULES)